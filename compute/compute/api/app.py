@@ -1,10 +1,30 @@
+import resource
+import time
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .log import logger  # noqa: F401
+from .log import logger
 from .routes import video, index, moderation
-from .xpocketbase import client # noqa: F401
+from .xpocketbase import init_client
+from .qdrant import ensure_collections
+from .audio.audio_detect.database.engine import create_tables
+
+startup: dict[str, float] = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    init_client()
+    ensure_collections()
+    create_tables()
+    startup['init_s'] = round(time.perf_counter() - start, 3)
+    logger.info(f'API is ready: {startup}')
+    yield
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 origins = "*"
 
 app.add_middleware(
@@ -16,8 +36,17 @@ app.add_middleware(
 )
 
 
+@app.get("/ready")
+async def ready():
+    return {
+        "ready": True,
+        **startup,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
 app.include_router(video.router)
 app.include_router(index.router)
 app.include_router(moderation.router)
 # app.include_router(audio.router)
-# app.include_router(mock_video.router)
\ No newline at end of file
+# app.include_router(mock_video.router)
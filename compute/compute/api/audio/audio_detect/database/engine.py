@@ -21,7 +21,5 @@ def get_session():
     return sessionmaker(bind=get_engine())()
 
 def create_tables():
+    """Creates missing tables, called once at startup"""
     Base.metadata.create_all(get_engine())
-    
-    
-create_tables()
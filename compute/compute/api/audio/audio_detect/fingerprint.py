@@ -1,6 +1,5 @@
 import numpy as np
 import json
-from spectromap.spectromap import spectromap
 from ...schema.audio import Config
 from operator import itemgetter
 from itertools import groupby
@@ -77,6 +76,8 @@ class Fingerprint:
         y = np.array,
         fs = default_cfg.sample_rate,
     ) -> list[tuple[str, int]]:
+        from spectromap.spectromap import spectromap
+
         # FFT the signal and extract frequency components
         smap = spectromap(
             y, 
@@ -1,6 +1,5 @@
 import json
 import os
-import librosa
 import numpy as np
 from ...schema.audio import Config
 
@@ -10,6 +9,7 @@ with open(cfg_path) as cfg:
 
 def read(filename: str) -> tuple[np.array, int]:
     if os.path.exists(filename):
+        import librosa
         return librosa.load(filename, sr=default_cfg.sample_rate)
     else:
         raise FileNotFoundError
\ No newline at end of file
@@ -14,7 +14,6 @@ from ...schema.audio import (
     MatchResult
 )
 import json
-from moviepy.editor import VideoFileClip
 from tempfile import NamedTemporaryFile
 import os
 
@@ -28,6 +27,8 @@ class Recognizer:
         self._dbman = DBManager()
 
     def upload_record(self, data: Dataset):
+        from moviepy.editor import VideoFileClip
+
         fingerprints: list[FingerprintData] = []
         record: RecordData = []
         record_id = data.record_id
@@ -62,6 +63,8 @@ class Recognizer:
         self._dbman.upload_fingerprints(fingerprints) 
 
     def upload_dataset(self, data: list[Dataset]):
+        from moviepy.editor import VideoFileClip
+
         fingerprints: list[FingerprintData] = []
         records: list[RecordData] = []
         for elem in data:
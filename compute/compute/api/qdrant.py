@@ -1,28 +1,359 @@
-from qdrant_client import QdrantClient, models
+"""
+Qdrant client and declarative provisioning of the frame collection.
+
+`COLLECTION` is an alias of a physical `<COLLECTION>__<settings hash>`
+collection created from the `QDRANT_*` settings below. Startup only
+creates it when missing and warns when the existing one differs from
+the settings; `python -m api.qdrant migrate` applies them, in place
+when Qdrant can update the parameters, otherwise by copying the points
+into a new collection and switching the alias. A copy needs every
+writer (`/index`, video deletion) stopped until it finishes: points
+written or deleted during the copy are not carried over, and it aborts
+when the point count of the source changed. Searches keep working
+throughout, the alias is switched in a single request; only collections
+created before aliases are briefly missing while their name is handed
+over to the alias.
+
+`SEGMENT_COLLECTION` holds temporally pooled embeddings of the frame
+collection, moderation searches them to shortlist source videos. `/index`
+writes them with `SEGMENT_INDEX=1` on the compute service;
+`python -m api.qdrant segments` backfills them for videos indexed without.
+"""
+import argparse
+import hashlib
+import json
+import logging
 import os
 
+from qdrant_client import QdrantClient, models
+
+from .vector.segments import SEGMENT_COLLECTION, pool_segments
+from .vector.store import COLLECTION, point_id
+
 QDRANT_API_KEY = os.getenv('QDRANT__SERVICE__API_KEY')
 QDRANT_HOST = os.getenv('QDRANT_HOST')
 QDRANT_PORT = os.getenv('QDRANT_PORT')
 
-qdrant = QdrantClient(
-    url=QDRANT_HOST,
-    api_key=QDRANT_API_KEY,
-    port=QDRANT_PORT,
-    timeout=3600
-)
-
-
-_cols = qdrant.get_collections()
-for col in _cols.collections:
-    if col.name == 'dev__experiment':
-        break
-else:
-    qdrant.create_collection(
-        'dev__experiment',
-        vectors_config=models.VectorParams(
-            size=1024,
-            distance=models.Distance.COSINE
+QDRANT_VECTOR_SIZE = int(os.getenv('QDRANT_VECTOR_SIZE', 1024))
+# `float32` or `float16` storage of the original vectors
+QDRANT_DATATYPE = os.getenv('QDRANT_DATATYPE', 'float32')
+# Keeps the original vectors on disk, search runs on the quantized ones in RAM
+QDRANT_ON_DISK = os.getenv('QDRANT_ON_DISK', '0') == '1'
+# `none`, `scalar` (int8) or `binary`
+QDRANT_QUANTIZATION = os.getenv('QDRANT_QUANTIZATION', 'none')
+QDRANT_HNSW_M = int(os.getenv('QDRANT_HNSW_M', 16))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv('QDRANT_HNSW_EF_CONSTRUCT', 100))
+QDRANT_HNSW_ON_DISK = os.getenv('QDRANT_HNSW_ON_DISK', '0') == '1'
+# Search-time parameters sent with every moderation request, empty keeps the collection defaults
+QDRANT_SEARCH_HNSW_EF = int(os.getenv('QDRANT_SEARCH_HNSW_EF', 0)) or None
+QDRANT_SEARCH_OVERSAMPLING = float(os.getenv('QDRANT_SEARCH_OVERSAMPLING', 0)) or None
+
+# Payload fields the services filter on
+PAYLOAD_INDEXES = {
+    'video_name': models.PayloadSchemaType.KEYWORD,
+    'video_id': models.PayloadSchemaType.INTEGER,
+    'second': models.PayloadSchemaType.FLOAT,
+}
+
+logger = logging.getLogger('uvicorn')
+
+_qdrant: QdrantClient | None = None
+
+
+def get_qdrant() -> QdrantClient:
+    """Process-wide client, created on first use"""
+    global _qdrant
+    if _qdrant is None:
+        _qdrant = QdrantClient(
+            url=QDRANT_HOST,
+            api_key=QDRANT_API_KEY,
+            port=QDRANT_PORT,
+            timeout=3600
         )
+    return _qdrant
+
+
+def vectors_config() -> models.VectorParams:
+    return models.VectorParams(
+        size=QDRANT_VECTOR_SIZE,
+        distance=models.Distance.COSINE,
+        on_disk=QDRANT_ON_DISK,
+        datatype=models.Datatype.FLOAT16 if QDRANT_DATATYPE == 'float16' else models.Datatype.FLOAT32,
+    )
+
+
+def hnsw_config() -> models.HnswConfigDiff:
+    return models.HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT, on_disk=QDRANT_HNSW_ON_DISK)
+
+
+def quantization_config() -> models.QuantizationConfig | None:
+    if QDRANT_QUANTIZATION == 'scalar':
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            quantile=0.99,
+            always_ram=True,
+        ))
+    if QDRANT_QUANTIZATION == 'binary':
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    if QDRANT_QUANTIZATION == 'none':
+        return None
+    raise ValueError(f'Unknown quantization: {QDRANT_QUANTIZATION}')
+
+
+def _quantization_kind(config) -> str:
+    if isinstance(config, models.ScalarQuantization):
+        return 'scalar'
+    if isinstance(config, models.BinaryQuantization):
+        return 'binary'
+    return 'none'
+
+
+def _physical_name(qdrant: QdrantClient) -> str | None:
+    """Collection `COLLECTION` points to, `COLLECTION` itself for collections created before aliases"""
+    for alias in qdrant.get_aliases().aliases:
+        if alias.alias_name == COLLECTION:
+            return alias.collection_name
+    if any(col.name == COLLECTION for col in qdrant.get_collections().collections):
+        return COLLECTION
+    return None
+
+
+def _drift(qdrant: QdrantClient, name: str) -> tuple[list[str], bool]:
+    """Settings the collection differs in, and whether they need a new collection"""
+    config = qdrant.get_collection(name).config
+    vectors = config.params.vectors
+    datatype = (getattr(vectors, 'datatype', None) or models.Datatype.FLOAT32).value
+    expected = vectors_config()
+
+    recreate = []
+    if vectors.size != expected.size:
+        recreate.append(f'size {vectors.size} -> {expected.size}')
+    if datatype != expected.datatype.value:
+        recreate.append(f'datatype {datatype} -> {expected.datatype.value}')
+
+    update = []
+    if bool(vectors.on_disk) != QDRANT_ON_DISK:
+        update.append(f'on_disk {bool(vectors.on_disk)} -> {QDRANT_ON_DISK}')
+    hnsw = config.hnsw_config
+    if (hnsw.m, hnsw.ef_construct, bool(hnsw.on_disk)) != (QDRANT_HNSW_M, QDRANT_HNSW_EF_CONSTRUCT, QDRANT_HNSW_ON_DISK):
+        update.append(
+            f'hnsw {(hnsw.m, hnsw.ef_construct, bool(hnsw.on_disk))} -> '
+            f'{(QDRANT_HNSW_M, QDRANT_HNSW_EF_CONSTRUCT, QDRANT_HNSW_ON_DISK)}'
+        )
+    if _quantization_kind(config.quantization_config) != QDRANT_QUANTIZATION:
+        update.append(f'quantization {_quantization_kind(config.quantization_config)} -> {QDRANT_QUANTIZATION}')
+    return recreate + update, bool(recreate)
+
+
+def _create(qdrant: QdrantClient) -> str:
+    """Creates the collection for the current settings unless another worker already did"""
+    settings = [
+        QDRANT_VECTOR_SIZE, QDRANT_DATATYPE, QDRANT_ON_DISK, QDRANT_QUANTIZATION,
+        QDRANT_HNSW_M, QDRANT_HNSW_EF_CONSTRUCT, QDRANT_HNSW_ON_DISK,
+    ]
+    name = f'{COLLECTION}__{hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:8]}'
+    if not qdrant.collection_exists(name):
+        try:
+            qdrant.create_collection(
+                name,
+                vectors_config=vectors_config(),
+                hnsw_config=hnsw_config(),
+                quantization_config=quantization_config(),
+            )
+        except Exception:
+            if not qdrant.collection_exists(name):
+                raise
+    return name
+
+
+def _ensure_payload_indexes(qdrant: QdrantClient, name: str):
+    schema = qdrant.get_collection(name).payload_schema
+    for field, field_type in PAYLOAD_INDEXES.items():
+        if field not in schema:
+            logger.info(f'Creating {field_type.value} payload index on {name}.{field}')
+            qdrant.create_payload_index(name, field_name=field, field_schema=field_type, wait=True)
+
+
+def video_filter(video_name: str) -> models.Filter:
+    """Points of one video"""
+    return models.Filter(must=[models.FieldCondition(key='video_name', match=models.MatchValue(value=video_name))])
+
+
+def _point_alias(qdrant: QdrantClient, name: str):
+    operations = [models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=name, alias_name=COLLECTION))]
+    if any(alias.alias_name == COLLECTION for alias in qdrant.get_aliases().aliases):
+        operations.insert(0, models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=COLLECTION)))
+    qdrant.update_collection_aliases(change_aliases_operations=operations)
+
+
+def _ensure_segments(qdrant: QdrantClient):
+    if not qdrant.collection_exists(SEGMENT_COLLECTION):
+        try:
+            qdrant.create_collection(SEGMENT_COLLECTION, vectors_config=vectors_config(), hnsw_config=hnsw_config())
+        except Exception:
+            if not qdrant.collection_exists(SEGMENT_COLLECTION):
+                raise
+    _ensure_payload_indexes(qdrant, SEGMENT_COLLECTION)
+
+
+def ensure_collections():
+    """Creates the collections the services expect, called once at startup"""
+    qdrant = get_qdrant()
+    _ensure_segments(qdrant)
+    name = _physical_name(qdrant)
+    if name is None:
+        name = _create(qdrant)
+        _ensure_payload_indexes(qdrant, name)
+        try:
+            _point_alias(qdrant, name)
+        except Exception:
+            # every worker provisions at startup, another one may have created the alias first
+            target = _physical_name(qdrant)
+            if target is None or not qdrant.collection_exists(target):
+                raise
+            logger.info(f'{COLLECTION} was pointed to {target} by another worker')
+        return
+
+    _ensure_payload_indexes(qdrant, name)
+    changes, _ = _drift(qdrant, name)
+    if changes:
+        logger.warning(f'Collection {name} differs from the settings ({", ".join(changes)}), run `python -m api.qdrant migrate`')
+
+
+def migrate(batch_size: int = 256):
+    """Brings the collection in line with the settings, writers have to be stopped for a copy"""
+    qdrant = get_qdrant()
+    name = _physical_name(qdrant)
+    if name is None:
+        ensure_collections()
+        return
+
+    changes, recreate = _drift(qdrant, name)
+    if not changes:
+        logger.info(f'Collection {name} is up to date')
+        return
+
+    if not recreate:
+        logger.info(f'Updating {name} in place: {", ".join(changes)}')
+        quantization = quantization_config()
+        qdrant.update_collection(
+            name,
+            vectors_config={'': models.VectorParamsDiff(on_disk=QDRANT_ON_DISK)},
+            hnsw_config=hnsw_config(),
+            quantization_config=quantization if quantization is not None else models.Disabled.DISABLED,
+        )
+        return
+
+    target = _create(qdrant)
+    _ensure_payload_indexes(qdrant, target)
+    logger.info(f'Copying {name} into {target}: {", ".join(changes)}')
+    offset = None
+    copied = 0
+    while True:
+        points, offset = qdrant.scroll(name, limit=batch_size, offset=offset, with_payload=True, with_vectors=True)
+        if points:
+            qdrant.upsert(target, points=[
+                models.PointStruct(id=point.id, vector=point.vector, payload=point.payload)
+                for point in points
+            ], wait=True)
+            copied += len(points)
+        if offset is None:
+            break
+    logger.info(f'Copied {copied} points')
+    if qdrant.count(name, exact=True).count != qdrant.count(target, exact=True).count:
+        raise RuntimeError(
+            f'{name} changed while it was copied into {target}, stop the writers and migrate again, '
+            f'{COLLECTION} still points to {name}'
+        )
+
+    if name == COLLECTION:
+        # the alias can only take the name once the original collection is gone,
+        # searches fail until it is created
+        qdrant.delete_collection(name)
+        _point_alias(qdrant, target)
+    else:
+        # one request: the alias never points nowhere
+        _point_alias(qdrant, target)
+        qdrant.delete_collection(name)
+    logger.info(f'{COLLECTION} now points to {target}')
+
+
+def _video_names(qdrant: QdrantClient, collection: str, batch_size: int) -> set[str]:
+    names = set()
+    offset = None
+    while True:
+        points, offset = qdrant.scroll(
+            collection, limit=batch_size, offset=offset,
+            with_payload=models.PayloadSelectorInclude(include=['video_name']), with_vectors=False,
+        )
+        names.update(point.payload['video_name'] for point in points)
+        if offset is None:
+            return names
+
+
+def backfill_segments(batch_size: int = 256, replace: bool = False):
+    """Pools the frames of every indexed video into `SEGMENT_COLLECTION`"""
+    import numpy as np
+
+    qdrant = get_qdrant()
+    _ensure_segments(qdrant)
+    done = set() if replace else _video_names(qdrant, SEGMENT_COLLECTION, batch_size)
+    videos = sorted(_video_names(qdrant, COLLECTION, batch_size) - done)
+    logger.info(f'Pooling the segments of {len(videos)} videos')
+    for i, video_name in enumerate(videos):
+        frames = []
+        offset = None
+        while True:
+            points, offset = qdrant.scroll(
+                COLLECTION, scroll_filter=video_filter(video_name), limit=batch_size, offset=offset,
+                with_payload=True, with_vectors=True,
+            )
+            frames.extend(points)
+            if offset is None:
+                break
+        frames.sort(key=lambda point: point.payload['frame'])
+        if not frames:
+            continue
+        starts, first, counts, segments = pool_segments(
+            np.array([point.payload['second'] for point in frames]),
+            np.array([point.vector for point in frames]),
+        )
+        ids = [point_id(video_name, frames[j].payload['frame']) for j in first]
+        qdrant.upsert(SEGMENT_COLLECTION, points=models.Batch(
+            ids=ids,
+            vectors=segments.tolist(),
+            payloads=[
+                {
+                    'video_id': frames[j].payload['video_id'],
+                    'video_name': video_name,
+                    'frame': frames[j].payload['frame'],
+                    'second': float(start),
+                    'frames': int(count),
+                }
+                for start, j, count in zip(starts, first, counts)
+            ],
+        ), wait=True)
+        qdrant.delete(SEGMENT_COLLECTION, points_selector=models.FilterSelector(filter=models.Filter(
+            must=video_filter(video_name).must,
+            must_not=[models.HasIdCondition(has_id=ids)],
+        )), wait=True)
+        logger.info(f'{i + 1}/{len(videos)} {video_name}: {len(segments)} segments')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser(
+        'migrate',
+        help='apply the collection settings to the existing collection, stop indexing and video deletion first',
     )
-    
\ No newline at end of file
+    migrate_parser.add_argument('--batch-size', type=int, default=256)
+    segments_parser = commands.add_parser('segments', help='pool the segments of the videos indexed without them')
+    segments_parser.add_argument('--batch-size', type=int, default=256)
+    segments_parser.add_argument('--replace', action='store_true', help='pool the segments of every video again')
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        migrate(args.batch_size)
+    else:
+        backfill_segments(args.batch_size, args.replace)
@@ -4,7 +4,7 @@ import logging
 import os
 import tempfile
 import aiohttp
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 import requests
 
 from ..schema.audio.dataset import Dataset
@@ -12,10 +12,10 @@ from ..schema.audio.dataset import Dataset
 from .models.video import SingleVideo, Violation
 
 from ..xpocketbase import client
+from ..qdrant import QDRANT_SEARCH_HNSW_EF, QDRANT_SEARCH_OVERSAMPLING
 from ..audio.audio_detect import Recognizer
 
 from pocketbase.utils import ClientResponseError
-from moviepy.editor import VideoFileClip
 
 router = APIRouter(tags=["Video Indexing"])
 api_logger = logging.getLogger('uvicorn')
@@ -26,7 +26,7 @@ QDRANT_HOST = os.getenv('QDRANT_HOST')
 QDRANT_PORT = os.getenv('QDRANT_PORT')
 
 
-async def compute_index(video_id, video_name, video_link):
+async def compute_index(video_id, video_name, video_link, replace: bool = False):
     async with aiohttp.ClientSession() as session:
         async with session.post(f'http://{COMPUTE_API}/index', json={
             "video_id": 0,
@@ -34,12 +34,25 @@ async def compute_index(video_id, video_name, video_link):
             "video_link": str(video_link),
             "qdrant_host": QDRANT_HOST,
             "qdrant_api_key": QDRANT_API_KEY,
-            "qdrant_port": QDRANT_PORT
+            "qdrant_port": QDRANT_PORT,
+            "replace": replace,
         }) as response:
             return await response.json()
+
+
+async def compute_delete(video_name):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f'http://{COMPUTE_API}/delete', json={
+            "video_name": str(video_name),
+            "qdrant_host": QDRANT_HOST,
+            "qdrant_api_key": QDRANT_API_KEY,
+            "qdrant_port": QDRANT_PORT,
+        }) as response:
+            response.raise_for_status()
+            return await response.json()
          
    
-async def run_moderate(video_link, threshold: float):
+async def run_moderate(video_link, threshold: float, video_names: list[str] | None = None):
     async with aiohttp.ClientSession() as session:
         async with session.post(f'http://{COMPUTE_API}/moderate', json={
             "video_link": str(video_link),
@@ -48,6 +61,9 @@ async def run_moderate(video_link, threshold: float):
             "qdrant_port": QDRANT_PORT,
             "batch_size": 256,
             "threshold": threshold,
+            "hnsw_ef": QDRANT_SEARCH_HNSW_EF,
+            "oversampling": QDRANT_SEARCH_OVERSAMPLING,
+            "video_names": video_names,
         }) as response:
             return await response.json()
             
@@ -76,7 +92,8 @@ async def index_video(
     
     file = client.get_file_url(db_response, db_response.video_file, {})
     
-    index_result = await compute_index(db_response.id, db_response.id, file)
+    # points of an earlier indexing are replaced rather than left next to the new ones
+    index_result = await compute_index(db_response.id, db_response.id, file, replace=bool(db_response.video_indexed))
     
     recognizer = Recognizer()
     recognizer.upload_record(Dataset(record_id=db_response.id, filename=file))
@@ -96,7 +113,8 @@ async def index_video(
 async def run_check(
     video_id: str,
     moderation_session_id: str,
-    threshold: float = 0.8
+    threshold: float = 0.8,
+    source_video_ids: list[str] | None = Query(None),
 ):
     try:
         db_response = client.collection('videos').get_one(video_id)
@@ -113,10 +131,12 @@ async def run_check(
     async with aiohttp.ClientSession() as session:
         async with session.get(file) as resp:
             violations, video_bytes = await asyncio.gather(
-                run_moderate(file, threshold),
+                run_moderate(file, threshold, source_video_ids),
                 resp.read()
             )
 
+    from moviepy.editor import VideoFileClip
+
     real_violations = []
     real_sources = []
     real_vvideos = []
@@ -129,6 +149,7 @@ async def run_check(
                 clip.audio.write_audiofile(file.name, fps=16000)
                 file.seek(0)
 
+                # `start` / `end` are 0-based frame numbers, frame `i` shows second `i / fps`
                 for v in violations:
                     v['video'] = client.collection('videos').get_one(v['video_name'])
                     
@@ -155,8 +176,9 @@ async def run_check(
                         "avg_score": v['avg_score'],
                         "std_score": v['std_score'],
                         "marked_hard": top.record_id == v['video'].id,
-                        "original_start": abs(int(top.offset_sec)),
-                        "original_end": abs(int(top.offset_sec)) + int(v['end'] / db_response.fps) - int(v['start'] / db_response.fps),
+                        # aligned by the frame search, the audio match only confirms the source
+                        "original_start": int(v['original_start']),
+                        "original_end": int(v['original_end']),
                     })
 
                     if moderation_session_id:
@@ -1,6 +1,5 @@
 from fastapi.responses import StreamingResponse
 from io import BytesIO
-import pandas as pd
 from fastapi import APIRouter
 from ..xpocketbase import client
 from .video import get_videos_with_violations
@@ -18,6 +17,8 @@ async def get_moderation_sessions():
 
 @router.get("/csv_report/", response_class=StreamingResponse)
 async def get_csv_report(moderation_session_id: str):
+    import pandas as pd
+
     video_with_violations = await get_videos_with_violations(moderation_session_id)
     
     data_ = {
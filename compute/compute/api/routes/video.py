@@ -1,11 +1,12 @@
+import asyncio
 import logging
 import os
 import shutil
 import tempfile
 
-import cv2
 from fastapi import APIRouter, Body, File, UploadFile, HTTPException, Query
 from typing import Annotated, Literal
+import aiohttp
 import base64
 import requests
 
@@ -13,8 +14,9 @@ from ..xpocketbase import client
 from .models.video import Embedding, GetVideosWithFilters, SingleVideo, UpdateVideo, VideoWithViolations, Filter, Violation
 from pocketbase.client import FileUpload
 from pocketbase.utils import ClientResponseError
-from ..qdrant import qdrant, models
+from ..qdrant import COLLECTION, get_qdrant, video_filter
 from ..audio.audio_detect.database.functions import get_fingerprints
+from .index import compute_delete
 
 router = APIRouter(tags=["Video Basic Operations"])
 api_logger = logging.getLogger('api')
@@ -33,6 +35,8 @@ async def upload_video(
     moderate_session_id: str | None = None
 ) -> SingleVideo:
     """Загрузка единичного видео в базу для последующей обработки."""
+    import cv2
+
     with tempfile.NamedTemporaryFile() as temp_file:
         shutil.copyfileobj(file.file, temp_file)
         temp_file.seek(0)
@@ -191,6 +195,13 @@ async def get_videos(
 async def delete_video(
     video_id: str
 ) -> bool:
+    # points, segments and frame matrices first, the record stays for a retry should the compute service fail
+    try:
+        await compute_delete(video_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        api_logger.error(f"DELETE /video: compute /delete failed: {e!r}")
+        raise HTTPException(status_code=502, detail=f"Could not delete the embeddings of the video, retry: {e!r}")
+
     try:
         db_response = client.collection('videos').delete(video_id)
     except ClientResponseError as e:
@@ -247,6 +258,8 @@ async def update_violation(
 def violation_frames(
     violation_id: str
 ):
+    import cv2
+
     try:
         db_response = client.collection('violations').get_one(violation_id)
     except ClientResponseError as e:
@@ -300,9 +313,9 @@ def get_embeddings(video_id: str) -> Embedding:
     points: dict[int, list[float]] = {}
     offset = None
     while True:
-        result, offset  = qdrant.scroll(
-            'dev__experiment',
-            scroll_filter=models.Filter(must=[models.FieldCondition(key='video_name', match=models.MatchValue(value=video_id))]),
+        result, offset  = get_qdrant().scroll(
+            COLLECTION,
+            scroll_filter=video_filter(video_id),
             limit=128,
             with_payload=True,
             with_vectors=True,
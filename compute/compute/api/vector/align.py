@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Width of the `source second - probe second` bins the hits vote into
+ALIGN_BIN_SECONDS = float(os.getenv('ALIGN_BIN_SECONDS', 2))
+# Probe frames an offset needs votes from to be aligned
+ALIGN_MIN_VOTES = int(os.getenv('ALIGN_MIN_VOTES', 3))
+# Aligned frames further apart than this are split into separate spans
+ALIGN_MAX_GAP_SECONDS = float(os.getenv('ALIGN_MAX_GAP_SECONDS', 50))
+# Shorter spans are not reported
+ALIGN_MIN_SPAN_SECONDS = float(os.getenv('ALIGN_MIN_SPAN_SECONDS', 10))
+
+
+def _votes(hits: pd.DataFrame) -> pd.Series:
+    """
+    Probe frames voting for every `(video_name, bin)`, counting the
+    neighbouring bins too so offsets on a bin edge are not split
+    """
+    votes = hits[['video_name', 'bin', 'frame']].drop_duplicates()
+    votes = pd.concat([votes.assign(bin=votes.bin + shift) for shift in (-1, 0, 1)], ignore_index=True)
+    return votes.drop_duplicates().groupby(['video_name', 'bin']).size().sort_values(ascending=False, kind='stable')
+
+
+def align_offsets(df: pd.DataFrame, threshold: float) -> list[dict]:
+    """
+    Hough-style alignment of the search hits of a probe video. Every hit
+    above `threshold` votes for its source video and the offset
+    `video_second - second` of the source frame to the probe frame, the
+    offsets most probe frames agree on are taken best first. Their hits
+    are split into spans of probe frames, every probe frame belongs to
+    the span of one alignment at most.
+
+    `df` holds the hits of all vectors, with the probe `frame` and its
+    `second` and the `video_name` and `video_second` of the hit. Returns
+    the spans with the probe frames they start and end at and the source
+    seconds they are copied from
+    """
+    hits = df[df.score > threshold]
+    if hits.empty:
+        return []
+    offsets = hits.video_second - hits.second
+    hits = hits.assign(offset=offsets, bin=np.round(offsets / ALIGN_BIN_SECONDS).astype(np.int64))
+    by_video = dict(tuple(hits.groupby('video_name')))
+
+    claimed = set()
+    violations = []
+    for (video_name, peak), votes in _votes(hits).items():
+        if votes < ALIGN_MIN_VOTES:
+            break
+        d = by_video[video_name]
+        d = d[((d.bin - peak).abs() <= 1) & ~d.frame.isin(claimed)]
+        if d.frame.nunique() < ALIGN_MIN_VOTES:
+            continue
+        # the best hit of every probe frame, patches and neighbouring source frames vote once
+        d = d.loc[d.groupby('frame').score.idxmax()].sort_values('second')
+        span_ids = (d.second.diff() > ALIGN_MAX_GAP_SECONDS).cumsum()
+        for _, span in d.groupby(span_ids):
+            start, end = span.second.iloc[0], span.second.iloc[-1]
+            if end - start < ALIGN_MIN_SPAN_SECONDS:
+                continue
+            offset = float(span.offset.median())
+            claimed.update(span.frame.tolist())
+            violations.append({
+                'start': int(span.frame.iloc[0]),
+                'end': int(span.frame.iloc[-1]),
+                'video_name': str(video_name),
+                'original_start': round(max(float(start) + offset, 0.), 3),
+                'original_end': round(max(float(end) + offset, 0.), 3),
+                'offset': round(offset, 3),
+                'votes': len(span),
+                'max_score': float(span.score.max()),
+                'min_score': float(span.score.min()),
+                'avg_score': float(span.score.mean()),
+                'std_score': float(span.score.std()),
+            })
+    return sorted(violations, key=lambda v: (v['start'], v['video_name']))
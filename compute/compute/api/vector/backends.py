@@ -0,0 +1,46 @@
+import argparse
+import os
+
+import torch
+
+from .base import BaseImageEmbedder
+
+# `torch`, `onnx` (ONNX Runtime) or `openvino` (ONNX Runtime + OpenVINO EP)
+VBACKEND = os.getenv('VBACKEND', 'torch')
+# `none`, `dynamic` or `static` int8 quantization for the ONNX backends
+VQUANT = os.getenv('VQUANT', 'none')
+
+
+def load_embedder(model_name: str, backend: str = VBACKEND, quantize: str = VQUANT) -> BaseImageEmbedder:
+    if backend == 'torch':
+        from .vit import VitImageEmbedder
+        return VitImageEmbedder(
+            model_name,
+            device=('cuda' if torch.cuda.is_available() else 'cpu')
+        )
+
+    if backend in ('onnx', 'openvino'):
+        from .onnxrt import OnnxImageEmbedder
+        return OnnxImageEmbedder(
+            model_name,
+            quantize=quantize,
+            provider=('openvino' if backend == 'openvino' else 'cpu')
+        )
+
+    raise ValueError(f'Unknown embedder backend: {backend}')
+
+
+
+def save_pretrained(model_name: str, path: str):
+    """Saves the processor and safetensors weights of a model for `VMODEL_PATH`"""
+    from transformers import AutoModel, AutoProcessor
+    AutoProcessor.from_pretrained(model_name).save_pretrained(path)
+    AutoModel.from_pretrained(model_name).save_pretrained(path, safe_serialization=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-serializes model weights, e.g. `python -m vector.backends /models/dinov2-large`')
+    parser.add_argument('path')
+    parser.add_argument('--model', default=os.getenv('VMODEL', 'facebook/dinov2-large'))
+    args = parser.parse_args()
+    save_pretrained(args.model, args.path)
@@ -1,9 +1,29 @@
 from abc import ABC, abstractmethod
 from typing import Iterable
+import numpy as np
 from PIL.Image import Image
 
 
 class BaseImageEmbedder(ABC):
+    # cumulative seconds spent preparing model inputs and running the model
+    preprocess_s: float = 0.
+    inference_s: float = 0.
+
+    @property
+    def input_side(self) -> int:
+        """Shorter image side the processor resizes inputs to"""
+        size = self.processor.size
+        return size.get('shortest_edge') or min(size.get('height', 224), size.get('width', 224))
+
     @abstractmethod
+    def vectorize_array(self, *images: Image, batch_size: int, dtype: np.dtype = np.float32) -> Iterable[np.ndarray]:
+        """Yields a contiguous `(n, dim)` embedding matrix per batch of images"""
+        pass
+
     def vectorize(self, *images: Image, batch_size: int) -> Iterable[list[float]]:
-        pass
\ No newline at end of file
+        for embeddings in self.vectorize_array(*images, batch_size=batch_size):
+            yield from embeddings.tolist()
+
+    def embed(self, *images: Image, batch_size: int, dtype: np.dtype = np.float32) -> np.ndarray:
+        """Embeds all images into a single `(len(images), dim)` matrix"""
+        return np.concatenate([*self.vectorize_array(*images, batch_size=batch_size, dtype=dtype)])
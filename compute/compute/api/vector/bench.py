@@ -0,0 +1,726 @@
+"""
+Micro-benchmarks for the compute server.
+
+Run from the directory containing the `vector` package, e.g.
+
+    python -m vector.bench preprocess --frames 32 --width 1920 --height 1080
+    python -m vector.bench startup --app vector.server:compute
+    python -m vector.bench e2e --output results.json --baseline baseline.json
+    python -m vector.bench store --vectors 200000 --qdrant-host localhost
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+MODEL = os.getenv('VMODEL', 'facebook/dinov2-large')
+
+
+def _random_frames(n: int, width: int, height: int, seed: int = 0) -> list[Image.Image]:
+    """Smooth random frames, so resampling sees realistic gradients instead of pure noise"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(n):
+        small = rng.integers(0, 256, size=(max(1, height // 32), max(1, width // 32), 3), dtype=np.uint8)
+        frames.append(Image.fromarray(small).resize((width, height), Image.BILINEAR))
+    return frames
+
+
+def _timeit(fn, repeat: int) -> tuple[float, object]:
+    result = fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def bench_preprocess(args):
+    import torch
+    from transformers import AutoProcessor
+    from .preprocess import BatchImagePreprocessor
+    from .patches import get_patches
+
+    processor = AutoProcessor.from_pretrained(args.model)
+    batched = BatchImagePreprocessor.from_processor(processor)
+    if batched is None:
+        # the embedders batch through the processor itself, as for fast (torchvision) processors
+        def batched(images):
+            return processor(images=images, return_tensors='pt')['pixel_values']
+
+    images = []
+    for frame in _random_frames(args.frames, args.width, args.height):
+        images.extend(patch for _, patch in get_patches(frame, 2))
+        images.append(frame)
+
+    def per_image():
+        return torch.cat([
+            processor(images=image, return_tensors='pt')['pixel_values']
+            for image in images
+        ], dim=0)
+
+    per_image_s, expected = _timeit(per_image, args.repeat)
+    batched_s, actual = _timeit(lambda: batched(images), args.repeat)
+    max_abs_diff = float((expected - actual).abs().max())
+
+    print(json.dumps({
+        'processor': type(processor).__name__,
+        'batched_by': 'processor' if not isinstance(batched, BatchImagePreprocessor) else 'BatchImagePreprocessor',
+        'images': len(images),
+        'per_image_s': round(per_image_s, 4),
+        'batched_s': round(batched_s, 4),
+        'speedup': round(per_image_s / batched_s, 2),
+        'max_abs_diff': max_abs_diff,
+    }, indent=2))
+    # indexed and moderated vectors are compared across both paths, their pixels have to agree
+    if max_abs_diff > args.tolerance:
+        raise SystemExit(f'Batched pixels differ from the processor by {max_abs_diff} > {args.tolerance}')
+
+
+def _frames(args) -> list[Image.Image]:
+    if getattr(args, 'video', None):
+        from .frames import make_frame_source
+        frames = []
+        for sampled in make_frame_source(args.video):
+            frames.append(sampled.image)
+            if len(frames) == args.frames:
+                break
+        return frames
+    return _random_frames(args.frames, args.width, args.height)
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def bench_regions(args):
+    import torch
+    from .vit import VitImageEmbedder
+    from .patches import get_grid_boxes, get_patches
+
+    emb = VitImageEmbedder(args.model, device=('cuda' if torch.cuda.is_available() else 'cpu'))
+    frames = _frames(args)
+    boxes = get_grid_boxes(2)
+
+    def crop_based():
+        images = []
+        for frame in frames:
+            images.extend(patch for _, patch in get_patches(frame, 2))
+            images.append(frame)
+        return emb.embed(*images, batch_size=args.batch_size).reshape(len(frames), len(boxes) + 1, -1)
+
+    def pooled():
+        return np.concatenate([*emb.vectorize_regions(*frames, boxes=boxes, batch_size=args.batch_size)])
+
+    crop_s, crop = _timeit(crop_based, args.repeat)
+    pool_s, pool = _timeit(pooled, args.repeat)
+
+    crop_regions = _normalize(crop[:, :-1].reshape(-1, crop.shape[-1]))
+    pool_regions = _normalize(pool[:, :-1].reshape(-1, pool.shape[-1]))
+    similarity = pool_regions @ crop_regions.T
+    matched = similarity.argmax(axis=1) == np.arange(len(pool_regions))
+    # the crop CLS vectors are what `/index` stores, pooled regions are searched against them
+    cls_cosine = np.sum(_normalize(crop[:, -1]) * _normalize(pool[:, -1]), axis=1)
+
+    print(json.dumps({
+        'frames': len(frames),
+        'crop_s_per_frame': round(crop_s / len(frames), 4),
+        'pool_s_per_frame': round(pool_s / len(frames), 4),
+        'speedup': round(crop_s / pool_s, 2),
+        'cls_cosine_mean': float(cls_cosine.mean()),
+        'cls_cosine_min': float(cls_cosine.min()),
+        'region_cosine_mean': float(np.diag(similarity).mean()),
+        'region_cosine_min': float(np.diag(similarity).min()),
+        f'region_above_{args.threshold}': float((np.diag(similarity) > args.threshold).mean()),
+        'region_top1_agreement': float(matched.mean()),
+    }, indent=2))
+
+
+def _probe_transforms(frames: list[Image.Image], seed: int = 0) -> dict[str, list[Image.Image]]:
+    """Re-uploads of every frame: as is, re-encoded, zoomed, cropped to its edges and as a picture-in-picture"""
+    import io
+
+    def jpeg(frame):
+        buffer = io.BytesIO()
+        frame.convert('RGB').save(buffer, format='JPEG', quality=30)
+        return Image.open(io.BytesIO(buffer.getvalue())).convert('RGB')
+
+    def crop(frame, box):
+        width, height = frame.size
+        return frame.crop((int(box[0] * width), int(box[1] * height), int(box[2] * width), int(box[3] * height)))
+
+    def pip(frame, background):
+        # a quarter-size copy in the bottom right corner of another frame
+        width, height = background.size
+        canvas = background.copy()
+        canvas.paste(frame.resize((width // 2, height // 2)), (width // 2, height // 2))
+        return canvas
+
+    shuffled = np.random.default_rng(seed).permutation(len(frames))
+    return {
+        'identity': list(frames),
+        'jpeg_q30': [jpeg(frame) for frame in frames],
+        'zoom_80': [crop(frame, (.1, .1, .9, .9)).resize(frame.size) for frame in frames],
+        'left_half': [crop(frame, (0., 0., .5, 1.)) for frame in frames],
+        'right_half': [crop(frame, (.5, 0., 1., 1.)) for frame in frames],
+        'pip': [pip(frame, frames[j if j != i else (j + 1) % len(frames)]) for i, (frame, j) in enumerate(zip(frames, shuffled))],
+    }
+
+
+def bench_accuracy(args):
+    """
+    Retrieval accuracy of `crop` and `pool` patch modes. The sampled frames
+    are indexed as `/index` does in each mode, re-uploads of them are
+    searched with all vectors `/moderate` sends per frame. A probe finds its
+    source when the best hit of any of its vectors is the source frame
+    """
+    import torch
+    from .vit import VitImageEmbedder
+    from .patches import get_grid_boxes, get_patches
+
+    emb = VitImageEmbedder(args.model, device=('cuda' if torch.cuda.is_available() else 'cpu'))
+    frames = _frames(args)
+    boxes = get_grid_boxes(2)
+
+    def index(mode):
+        if mode == 'crop':
+            return _normalize(emb.embed(*frames, batch_size=args.batch_size))
+        regions = np.concatenate([*emb.vectorize_regions(*frames, boxes=[], batch_size=args.batch_size)])
+        return _normalize(regions[:, -1])
+
+    def queries(mode, probes):
+        if mode == 'crop':
+            images = []
+            for probe in probes:
+                images.extend(patch for _, patch in get_patches(probe, 2))
+                images.append(probe)
+            vectors = emb.embed(*images, batch_size=args.batch_size).reshape(len(probes), len(boxes) + 1, -1)
+        else:
+            vectors = np.concatenate([*emb.vectorize_regions(*probes, boxes=boxes, batch_size=args.batch_size)])
+        return _normalize(vectors)
+
+    results = {'frames': len(frames), 'threshold': args.threshold}
+    for mode in ('crop', 'pool'):
+        indexed = index(mode)
+        mode_results = {}
+        start = time.perf_counter()
+        for name, probes in _probe_transforms(frames).items():
+            # [probe, vector, indexed frame]
+            similarity = queries(mode, probes) @ indexed.T
+            best = similarity.max(axis=1)
+            source = np.diagonal(similarity, axis1=0, axis2=2).T.max(axis=1)
+            mode_results[name] = {
+                'top1': float((best.argmax(axis=1) == np.arange(len(probes))).mean()),
+                'source_score_mean': float(source.mean()),
+                'source_above_threshold': float((source > args.threshold).mean()),
+            }
+        mode_results['query_s_per_frame'] = round((time.perf_counter() - start) / len(frames) / 6, 4)
+        results[mode] = mode_results
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+def bench_backend(args):
+    from .backends import load_embedder
+
+    frames = _frames(args)
+    reference = load_embedder(args.model, backend='torch')
+    candidate = load_embedder(args.model, backend=args.backend, quantize=args.quantize)
+
+    ref_s, expected = _timeit(lambda: reference.embed(*frames, batch_size=args.batch_size), args.repeat)
+    cand_s, actual = _timeit(lambda: candidate.embed(*frames, batch_size=args.batch_size), args.repeat)
+    cosine = (_normalize(expected) * _normalize(actual)).sum(axis=1)
+
+    print(json.dumps({
+        'backend': args.backend,
+        'quantize': args.quantize,
+        'images': len(frames),
+        'torch_images_per_s': round(len(frames) / ref_s, 2),
+        'backend_images_per_s': round(len(frames) / cand_s, 2),
+        'speedup': round(ref_s / cand_s, 2),
+        'cosine_mean': float(cosine.mean()),
+        'cosine_min': float(cosine.min()),
+    }, indent=2))
+    if cosine.min() < args.min_cosine:
+        raise SystemExit(f'Parity check failed: min cosine {cosine.min():.4f} < {args.min_cosine}')
+
+
+def _rss_mb(pid: int) -> float:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.
+
+
+def _children(pid: int) -> list[int]:
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def bench_startup(args):
+    import socket
+    import subprocess
+    import sys
+    import requests
+
+    runs = []
+    for _ in range(args.repeat):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', args.app, '--host', '127.0.0.1', '--port', str(port), '--workers', str(args.workers)],
+            cwd=args.cwd,
+        )
+        try:
+            listening_s = None
+            while True:
+                if process.poll() is not None:
+                    raise SystemExit(f'{args.app} exited with code {process.returncode}')
+                if time.perf_counter() - start > args.timeout:
+                    raise SystemExit(f'{args.app} was not ready after {args.timeout}s')
+                try:
+                    status = requests.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code
+                except requests.ConnectionError:
+                    time.sleep(0.05)
+                    continue
+                if listening_s is None:
+                    listening_s = time.perf_counter() - start
+                # builds without `/ready` are ready as soon as they listen
+                if status in (200, 404):
+                    break
+                time.sleep(0.05)
+            ready_s = time.perf_counter() - start
+
+            workers = _children(process.pid) if args.workers > 1 else [process.pid]
+            runs.append({
+                'listening_s': round(listening_s, 3),
+                'ready_s': round(ready_s, 3),
+                'worker_rss_mb': [round(_rss_mb(pid), 1) for pid in workers],
+            })
+        finally:
+            process.terminate()
+            process.wait()
+
+    rss = [mb for run in runs for mb in run['worker_rss_mb']]
+    print(json.dumps({
+        'app': args.app,
+        'workers': args.workers,
+        'listening_s': round(float(np.mean([run['listening_s'] for run in runs])), 3),
+        'ready_s': round(float(np.mean([run['ready_s'] for run in runs])), 3),
+        'worker_rss_mb': round(float(np.mean(rss)), 1) if rss else None,
+        'runs': runs,
+    }, indent=2))
+
+
+def _synthetic_video(path: str, width: int, height: int, fps: float, seconds: float, seed: int = 0):
+    """Panning smooth-noise scenes cut every 4 seconds, with an object moving over them"""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    scene = max(1, int(fps * 4))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    try:
+        for i in range(int(round(fps * seconds))):
+            if i % scene == 0:
+                small = rng.integers(0, 256, size=(max(1, height // 32), max(1, width // 16), 3), dtype=np.uint8)
+                background = cv2.resize(small, (width * 2, height), interpolation=cv2.INTER_CUBIC)
+            shift = (i % scene) * width // (2 * scene)
+            frame = np.ascontiguousarray(background[:, shift:shift + width])
+            t = i / fps
+            center = (int(width / 2 + width / 3 * np.cos(t)), int(height / 2 + height / 3 * np.sin(2 * t)))
+            cv2.circle(frame, center, max(4, height // 10), (255, 255, 255), -1)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+
+def _video_spec(spec: str) -> tuple[int, int, float, float]:
+    """`WIDTHxHEIGHT@FPS:SECONDS`, e.g. `1280x720@30:20`"""
+    size, timing = spec.split('@')
+    width, height = size.split('x')
+    fps, seconds = timing.split(':')
+    return int(width), int(height), float(fps), float(seconds)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def _peak_rss(interval: float = 0.02):
+    """Samples the RSS of this process in the background, `peak['mb']` is the maximum seen"""
+    peak = {'mb': _rss_mb(os.getpid())}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak['mb'] = max(peak['mb'], _rss_mb(os.getpid()))
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield peak
+    finally:
+        stop.set()
+        thread.join()
+        peak['mb'] = max(peak['mb'], _rss_mb(os.getpid()))
+
+
+def _response_stats(response) -> dict[str, float]:
+    """Parses the `X-Compute-*` headers back into the stats they were made from"""
+    return {
+        key[len('x-compute-'):].replace('-', '_'): float(value)
+        for key, value in response.headers.items()
+        if key.startswith('x-compute-')
+    }
+
+
+def _compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Annotates runs with their ratio to the baseline and lists regressions"""
+    base_runs = {(run['endpoint'], run['video']): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        base = base_runs.get((run['endpoint'], run['video']))
+        if base is None:
+            continue
+        run['vs_baseline'] = {
+            'frames_per_s': round(run['frames_per_s'] / base['frames_per_s'], 3) if base['frames_per_s'] else None,
+            'peak_rss_mb': round(run['peak_rss_mb'] / base['peak_rss_mb'], 3) if base['peak_rss_mb'] else None,
+        }
+        name = f"{run['endpoint']} {run['video']}"
+        if run['frames_per_s'] < base['frames_per_s'] * (1 - tolerance):
+            regressions.append(f"{name}: {run['frames_per_s']} frames/s, baseline {base['frames_per_s']}")
+        if run['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {run['peak_rss_mb']} MB, baseline {base['peak_rss_mb']}")
+    return regressions
+
+
+def bench_e2e(args):
+    from fastapi import Response
+    from qdrant_client import models
+    from . import server
+    from .qdrant_pool import QdrantEndpoint
+    from .segments import SEGMENT_COLLECTION
+
+    if not args.cache:
+        server.cache = None
+
+    start = time.perf_counter()
+    server.runtime.load()
+    scheduler = server.runtime.get()
+    load_s = time.perf_counter() - start
+    emb = scheduler.emb
+
+    qdrant = QdrantEndpoint(':memory:', '', 6333).client()
+    dim = scheduler.embed(*_random_frames(1, 64, 64)).shape[-1]
+    for collection in ('dev__experiment', SEGMENT_COLLECTION):
+        qdrant.create_collection(collection, vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE))
+
+    runs = []
+    with tempfile.TemporaryDirectory() as folder:
+        videos = []
+        for i, spec in enumerate(args.videos.split(',')):
+            width, height, fps, seconds = _video_spec(spec)
+            name = f'{width}x{height}_{fps:g}fps_{seconds:g}s'
+            _synthetic_video(os.path.join(folder, name + '.mp4'), width, height, fps, seconds, seed=i)
+            videos.append((i, name, seconds))
+
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_QuietHandler, directory=folder))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{httpd.server_address[1]}'
+
+        try:
+            for endpoint in ('index', 'moderate'):
+                for video_id, name, seconds in videos:
+                    link = f'{base_url}/{name}.mp4'
+                    if endpoint == 'index':
+                        call = functools.partial(server.index_video, server.IndexBody(
+                            video_id=video_id, video_name=name, video_link=link,
+                            qdrant_host=':memory:', qdrant_api_key='', qdrant_port=6333,
+                        ))
+                    else:
+                        call = functools.partial(server.moderate, server.ModerateBody(
+                            video_link=link, qdrant_host=':memory:', qdrant_api_key='', qdrant_port=6333,
+                            batch_size=args.batch_size,
+                        ))
+
+                    for _ in range(args.repeat):
+                        preprocess_s, inference_s = emb.preprocess_s, emb.inference_s
+                        response = Response()
+                        with _peak_rss() as peak:
+                            start = time.perf_counter()
+                            call(response)
+                            wall_s = time.perf_counter() - start
+
+                        stats = _response_stats(response)
+                        stages = {
+                            'download_s': stats.get('download_s'),
+                            'decode_s': stats.get('decode_s'),
+                            'preprocess_s': round(emb.preprocess_s - preprocess_s, 3),
+                            'inference_s': round(emb.inference_s - inference_s, 3),
+                            'search_s': stats.get('search_busy_s'),
+                            'upsert_s': stats.get('upsert_s'),
+                            'clustering_s': stats.get('clustering_s'),
+                        }
+                        frames = int(stats.get('frames_decoded', 0))
+                        runs.append({
+                            'endpoint': endpoint,
+                            'video': name,
+                            'wall_s': round(wall_s, 3),
+                            'frames': frames,
+                            'frames_per_s': round(frames / wall_s, 2),
+                            'video_s_per_s': round(seconds / wall_s, 2),
+                            'peak_rss_mb': round(peak['mb'], 1),
+                            'stages': {stage: value for stage, value in stages.items() if value is not None},
+                            'stats': stats,
+                        })
+        finally:
+            httpd.shutdown()
+
+    results = {
+        'config': {
+            'model': server.MODEL,
+            'backend': server.VBACKEND,
+            'quantize': server.VQUANT,
+            'patch_mode': server.PATCH_MODE,
+            'frame_decoder': server.FRAME_DECODER,
+            'frame_short_side': server.FRAME_SHORT_SIDE,
+            'cache': args.cache,
+            'load_s': round(load_s, 3),
+        },
+        'runs': runs,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    if regressions:
+        raise SystemExit('Regressions against the baseline:\n' + '\n'.join(regressions))
+
+
+def _synthetic_catalog(videos: int, frames: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Unit vectors of `videos` videos of `frames` frames each, drifting slowly around a per-video direction"""
+    rng = np.random.default_rng(seed)
+    vectors = np.empty((videos * frames, dim), dtype=np.float32)
+    for video in range(videos):
+        center = _normalize(rng.standard_normal(dim).astype(np.float32))
+        drift = np.cumsum(rng.standard_normal((frames, dim)).astype(np.float32) * 0.02, axis=0)
+        noise = rng.standard_normal((frames, dim)).astype(np.float32) * 0.03
+        vectors[video * frames:(video + 1) * frames] = _normalize(center + drift + noise)
+    return vectors
+
+
+def _exact_top(vectors: np.ndarray, queries: np.ndarray, k: int, videos: int) -> tuple[np.ndarray, np.ndarray]:
+    """Best `k` rows and best `k` videos (by their best frame) of every query"""
+    rows = np.empty((len(queries), k), dtype=np.int64)
+    best_videos = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), 256):
+        scores = queries[start:start + 256] @ vectors.T
+        for out, candidates in ((rows, scores), (best_videos, scores.reshape(len(scores), videos, -1).max(axis=2))):
+            part = np.argpartition(-candidates, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(candidates, part, axis=1), axis=1)
+            out[start:start + 256] = np.take_along_axis(part, order, axis=1)
+    return rows, best_videos
+
+
+def bench_store(args):
+    from qdrant_client import models
+    from . import local_store
+    from .local_store import LocalStore
+    from .qdrant_pool import QdrantEndpoint
+    from .store import QdrantStore
+
+    frames = args.vectors // args.videos
+    vectors = _synthetic_catalog(args.videos, frames, args.dim)
+    video_of = np.repeat(np.arange(args.videos), frames)
+    rng = np.random.default_rng(1)
+    # probe frames: slightly perturbed copies of catalog frames, as re-encoding leaves them
+    probes = rng.choice(len(vectors), args.queries, replace=False)
+    queries = _normalize(vectors[probes] + rng.standard_normal((args.queries, args.dim)).astype(np.float32) * 0.02)
+    exact, exact_videos = _exact_top(vectors, queries, args.limit, args.videos)
+    ids = [f'{row:032x}' for row in range(len(vectors))]
+    payloads = [
+        {'video_id': int(video), 'video_name': f'video_{video}', 'frame': int(row % frames), 'second': float(row % frames)}
+        for row, video in enumerate(video_of)
+    ]
+
+    def run(store) -> dict:
+        start = time.perf_counter()
+        for i in range(0, len(vectors), args.upsert_batch):
+            store.upsert(ids[i:i + args.upsert_batch], vectors[i:i + args.upsert_batch], payloads[i:i + args.upsert_batch])
+        upsert_s = time.perf_counter() - start
+        result = {'upsert_per_s': round(len(vectors) / upsert_s, 1)}
+        if isinstance(store, LocalStore):
+            # trained in the background once the store outgrows exact search
+            start = time.perf_counter()
+            store.build()
+            result['build_s'] = round(time.perf_counter() - start, 3)
+        for grouped in (False, True):
+            latencies, hits = [], []
+            for i in range(0, len(queries), args.search_batch):
+                start = time.perf_counter()
+                hits.extend(store.search(
+                    queries[i:i + args.search_batch], args.limit, group_by='video_name' if grouped else None,
+                ))
+                latencies.append(time.perf_counter() - start)
+            if grouped:
+                recall = np.mean([
+                    len({int(hit.payload['video_name'].split('_')[1]) for hit in found} & set(truth.tolist())) / args.limit
+                    for found, truth in zip(hits, exact_videos)
+                ])
+            else:
+                recall = np.mean([
+                    len({int(hit.id.replace('-', ''), 16) for hit in found} & set(truth.tolist())) / args.limit
+                    for found, truth in zip(hits, exact)
+                ])
+            result['grouped' if grouped else 'points'] = {
+                'queries_per_s': round(len(queries) / sum(latencies), 1),
+                'batch_p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2),
+                'batch_p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 2),
+                f'recall_at_{args.limit}': round(float(recall), 4),
+            }
+        return result
+
+    results = {'config': {key: value for key, value in vars(args).items() if key != 'run'}}
+    with tempfile.TemporaryDirectory() as folder:
+        local_store.VSTORE_TRAIN_SIZE = args.train_size
+        local_store.VSTORE_EXACT_ROWS = args.train_size
+        results['local'] = run(LocalStore(folder))
+
+    endpoint = QdrantEndpoint(args.qdrant_host, args.qdrant_api_key, args.qdrant_port)
+    client = endpoint.client()
+    if client.collection_exists('bench__store'):
+        client.delete_collection('bench__store')
+    client.create_collection('bench__store', vectors_config=models.VectorParams(size=args.dim, distance=models.Distance.COSINE))
+    client.create_payload_index('bench__store', field_name='video_name', field_schema=models.PayloadSchemaType.KEYWORD)
+    try:
+        results['qdrant'] = run(QdrantStore(endpoint, collection='bench__store'))
+    finally:
+        client.delete_collection('bench__store')
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = commands.add_parser('preprocess', help='HF per-image processor vs batched preprocessing')
+    preprocess.add_argument('--model', default=MODEL)
+    preprocess.add_argument('--frames', type=int, default=32)
+    preprocess.add_argument('--width', type=int, default=1920)
+    preprocess.add_argument('--height', type=int, default=1080)
+    preprocess.add_argument('--repeat', type=int, default=3)
+    preprocess.add_argument('--tolerance', type=float, default=1e-5, help='largest pixel difference accepted')
+    preprocess.set_defaults(run=bench_preprocess)
+
+    regions = commands.add_parser('regions', help='crop-based patch embeddings vs regions pooled from one forward pass')
+    regions.add_argument('--model', default=MODEL)
+    regions.add_argument('--video', default=None, help='take frames from a video instead of generating them')
+    regions.add_argument('--frames', type=int, default=16)
+    regions.add_argument('--width', type=int, default=1280)
+    regions.add_argument('--height', type=int, default=720)
+    regions.add_argument('--batch-size', type=int, default=32)
+    regions.add_argument('--repeat', type=int, default=1)
+    regions.add_argument('--threshold', type=float, default=0.88, help='moderation similarity threshold')
+    regions.set_defaults(run=bench_regions)
+
+    accuracy = commands.add_parser(
+        'accuracy', help='source frame retrieval of crop-based and pooled patch modes over re-uploads of the frames, '
+        'pass `--video` with real footage: generated frames say nothing about accuracy'
+    )
+    accuracy.add_argument('--model', default=MODEL)
+    accuracy.add_argument('--video', default=None, help='take frames from a video instead of generating them')
+    accuracy.add_argument('--frames', type=int, default=64)
+    accuracy.add_argument('--width', type=int, default=1280)
+    accuracy.add_argument('--height', type=int, default=720)
+    accuracy.add_argument('--batch-size', type=int, default=32)
+    accuracy.add_argument('--threshold', type=float, default=0.88, help='moderation similarity threshold')
+    accuracy.add_argument('--output', default=None, help='write the results JSON to a file')
+    accuracy.set_defaults(run=bench_accuracy)
+
+    backend = commands.add_parser('backend', help='parity and throughput of an embedder backend against eager PyTorch')
+    backend.add_argument('--model', default=MODEL)
+    backend.add_argument('--backend', default='onnx', choices=['onnx', 'openvino'])
+    backend.add_argument('--quantize', default='none', choices=['none', 'dynamic', 'static'])
+    backend.add_argument('--video', default=None, help='take frames from a video instead of generating them')
+    backend.add_argument('--frames', type=int, default=64)
+    backend.add_argument('--width', type=int, default=1280)
+    backend.add_argument('--height', type=int, default=720)
+    backend.add_argument('--batch-size', type=int, default=16)
+    backend.add_argument('--repeat', type=int, default=2)
+    backend.add_argument('--min-cosine', type=float, default=0.98)
+    backend.set_defaults(run=bench_backend)
+
+    startup = commands.add_parser('startup', help='cold start time and per-worker RSS of a server, until `/ready` answers')
+    startup.add_argument('--app', default='vector.server:compute', help='uvicorn app, e.g. `api.app:app` for the API service')
+    startup.add_argument('--cwd', default='.', help='directory the app is imported from')
+    startup.add_argument('--workers', type=int, default=1)
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--timeout', type=float, default=600)
+    startup.set_defaults(run=bench_startup)
+
+    e2e = commands.add_parser('e2e', help='`/index` and `/moderate` over synthetic videos against an in-memory Qdrant')
+    e2e.add_argument('--videos', default='640x360@25:20,1280x720@30:20,1920x1080@24:10', help='`WIDTHxHEIGHT@FPS:SECONDS,...`')
+    e2e.add_argument('--batch-size', type=int, default=256)
+    e2e.add_argument('--repeat', type=int, default=1)
+    e2e.add_argument('--cache', action='store_true', help='keep the embedding cache enabled')
+    e2e.add_argument('--output', default=None, help='write the results JSON to a file')
+    e2e.add_argument('--baseline', default=None, help='results JSON of a previous run to compare against')
+    e2e.add_argument('--tolerance', type=float, default=0.1, help='allowed relative frames/s drop and peak RSS growth')
+    e2e.set_defaults(run=bench_e2e)
+
+    store = commands.add_parser(
+        'store', help='upsert throughput, search latency and recall of the local store against Qdrant, '
+        'pass `--qdrant-host` of a server: the in-memory Qdrant is a reference implementation'
+    )
+    store.add_argument('--vectors', type=int, default=100_000)
+    store.add_argument('--videos', type=int, default=200)
+    store.add_argument('--dim', type=int, default=1024)
+    store.add_argument('--queries', type=int, default=2048)
+    store.add_argument('--limit', type=int, default=5)
+    store.add_argument('--upsert-batch', type=int, default=256)
+    store.add_argument('--search-batch', type=int, default=256)
+    store.add_argument('--train-size', type=int, default=50_000, help='rows the local store searches exactly')
+    store.add_argument('--qdrant-host', default=':memory:')
+    store.add_argument('--qdrant-api-key', default='')
+    store.add_argument('--qdrant-port', type=int, default=6333)
+    store.add_argument('--output', default=None, help='write the results JSON to a file')
+    store.set_defaults(run=bench_store)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+# Empty disables the cache
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', '')
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+
+logger = logging.getLogger('uvicorn')
+
+
+class CachedEmbeddings:
+    def __init__(self, vectors: np.ndarray, meta: dict[str, np.ndarray]):
+        self.vectors = vectors
+        self.meta = meta
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of per-video embedding matrices.
+
+    Entries are keyed by the video content hash plus everything that
+    changes the embeddings (model, sampling, patch mode...). Vectors are
+    stored as `.npy` and memory-mapped on read, per-row metadata as
+    `.npz`. Reads refresh the entry mtime and the least recently used
+    entries are evicted once the cache grows past `max_bytes`.
+    """
+    def __init__(self, root: str, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(sha256: str, **params) -> str:
+        return hashlib.sha256(json.dumps({'video': sha256, **params}, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, key: str) -> CachedEmbeddings | None:
+        path = self._path(key)
+        try:
+            vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+            with np.load(os.path.join(path, 'meta.npz')) as meta:
+                meta = dict(meta)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return CachedEmbeddings(vectors, meta)
+
+    def put(self, key: str, vectors: np.ndarray, **meta: np.ndarray):
+        path = self._path(key)
+        tmp = os.path.join(self.root, f'.{key}.{uuid.uuid4().hex}')
+        os.makedirs(tmp)
+        try:
+            np.save(os.path.join(tmp, 'vectors.npy'), np.ascontiguousarray(vectors))
+            np.savez(os.path.join(tmp, 'meta.npz'), **meta)
+            with self._lock:
+                if os.path.exists(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            logger.exception(f'Could not write embedding cache entry {key}')
+            return
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.root):
+                path = self._path(name)
+                if name.startswith('.') or not os.path.isdir(path):
+                    continue
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+cache = EmbeddingCache(EMBEDDING_CACHE_DIR) if EMBEDDING_CACHE_DIR else None
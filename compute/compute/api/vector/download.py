@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1 << 20))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv('DOWNLOAD_CONNECT_TIMEOUT', 10))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv('DOWNLOAD_READ_TIMEOUT', 60))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', 5))
+# Lets FFmpeg read the video straight from the link with ranged requests,
+# so decoding starts with the first bytes and nothing is kept on disk
+VIDEO_STREAM_DECODE = os.getenv('VIDEO_STREAM_DECODE', '0') == '1'
+
+logger = logging.getLogger('uvicorn')
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Process-wide session with pooled keep-alive connections"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=DOWNLOAD_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=('GET', 'HEAD'),
+            )
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+@dataclass
+class FetchedVideo:
+    path: str
+    # content hash, unknown when the video is decoded straight from the link
+    sha256: str | None = None
+
+
+def download_to(link: str, file) -> tuple[int, str]:
+    """
+    Streams `link` into an open binary file chunk by chunk.
+
+    A broken transfer is resumed with a `Range` request from the last
+    written byte; servers without range support restart from scratch.
+    Returns the number of bytes written and their SHA-256.
+    """
+    session = get_session()
+    written = 0
+    digest = hashlib.sha256()
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        headers = {'Range': f'bytes={written}-'} if written else {}
+        try:
+            with session.get(
+                link,
+                headers=headers,
+                stream=True,
+                timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+            ) as response:
+                response.raise_for_status()
+                if written and response.status_code != 206:
+                    file.seek(0)
+                    file.truncate()
+                    written = 0
+                    digest = hashlib.sha256()
+
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+            file.flush()
+            return written, digest.hexdigest()
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f'Download of {link} interrupted at {written} bytes, resuming: {e}')
+
+
+@contextmanager
+def fetch_video(link: str, suffix: str = '.mp4') -> Iterator[FetchedVideo]:
+    """Yields a path (or an URL) the frame source can open"""
+    if VIDEO_STREAM_DECODE:
+        yield FetchedVideo(link)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        _, sha256 = download_to(link, f)
+        yield FetchedVideo(f.name, sha256)
@@ -0,0 +1,338 @@
+import math
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterator
+
+import cv2
+import numpy as np
+from PIL import Image
+
+DEFAULT_FPS = 25.0
+# `opencv` decodes in-process, `ffmpeg` pipes already sampled and scaled frames
+FRAME_DECODER = os.getenv('FRAME_DECODER', 'opencv')
+FFMPEG_BIN = os.getenv('FFMPEG_BIN', 'ffmpeg')
+# Decoding threads of the `ffmpeg` decoder, `0` lets FFmpeg pick
+FRAME_DECODE_THREADS = int(os.getenv('FRAME_DECODE_THREADS', 0))
+# Max differing bits of the 256-bit difference hash for a sampled frame
+# to count as a repeat of the last embedded one, negative disables the gate
+FRAME_GATE_DISTANCE = int(os.getenv('FRAME_GATE_DISTANCE', -1))
+# Sampled frames below any of these are dropped as blank / low-information:
+# grayscale std (0-255), histogram entropy (bits) and share of edge pixels
+FRAME_MIN_STD = float(os.getenv('FRAME_MIN_STD', 4.0))
+FRAME_MIN_ENTROPY = float(os.getenv('FRAME_MIN_ENTROPY', 1.0))
+FRAME_MIN_EDGE_DENSITY = float(os.getenv('FRAME_MIN_EDGE_DENSITY', 0.0))
+
+_SHOWINFO_PTS = re.compile(rb'\] n:\s*\d+ pts:\s*(\d+)')
+
+
+@dataclass
+class SampledFrame:
+    index: int
+    second: float
+    image: Image.Image
+    # index of the last embedded frame this one repeats, if any
+    duplicate_of: int | None = None
+
+
+@dataclass
+class FrameStats:
+    decoded: int = 0
+    skipped: int = 0
+    gated: int = 0
+    dropped: dict[str, int] = field(default_factory=dict)
+    # seconds spent producing sampled frames: decoding, scaling, filtering and gating
+    decode_s: float = 0.
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            'decode_s': round(self.decode_s, 3),
+            'frames_decoded': self.decoded,
+            'frames_skipped': self.skipped,
+            'frames_gated': self.gated,
+            'frames_dropped': sum(self.dropped.values()),
+            **{f'frames_dropped_{reason}': count for reason, count in self.dropped.items()},
+        }
+
+
+class FrameQualityFilter:
+    """
+    Flags blank and low-information frames (black frames, fades, solid
+    color slates) from cheap statistics of a small grayscale thumbnail
+    """
+    def __init__(
+        self,
+        min_std: float = FRAME_MIN_STD,
+        min_entropy: float = FRAME_MIN_ENTROPY,
+        min_edge_density: float = FRAME_MIN_EDGE_DENSITY,
+        side: int = 96,
+        edge_threshold: int = 16,
+    ):
+        self.min_std = min_std
+        self.min_entropy = min_entropy
+        self.min_edge_density = min_edge_density
+        self.side = side
+        self.edge_threshold = edge_threshold
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_std > 0 or self.min_entropy > 0 or self.min_edge_density > 0
+
+    def reject(self, image: Image.Image) -> str | None:
+        """Name of the first failed check, `None` for frames worth embedding"""
+        gray = np.asarray(image.convert('L').resize((self.side, self.side), Image.BILINEAR), dtype=np.int16)
+        if gray.std() < self.min_std:
+            return 'flat'
+
+        if self.min_entropy > 0:
+            p = np.bincount(gray.ravel(), minlength=256) / gray.size
+            p = p[p > 0]
+            if -(p * np.log2(p)).sum() < self.min_entropy:
+                return 'low_entropy'
+
+        if self.min_edge_density > 0:
+            edges = (np.abs(np.diff(gray, axis=0))[:, :-1] + np.abs(np.diff(gray, axis=1))[:-1]) > self.edge_threshold
+            if edges.mean() < self.min_edge_density:
+                return 'no_edges'
+
+        return None
+
+
+class FrameGate:
+    """
+    Marks sampled frames that are near-identical to the last frame let
+    through, comparing difference hashes (dHash) of downscaled grayscale
+    frames, so static scenes are embedded once
+    """
+    def __init__(self, max_distance: int, hash_size: int = 16):
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self._hash: np.ndarray | None = None
+        self._index: int | None = None
+
+    def dhash(self, image: Image.Image) -> np.ndarray:
+        small = np.asarray(
+            image.convert('L').resize((self.hash_size + 1, self.hash_size), Image.BILINEAR),
+            dtype=np.int16
+        )
+        return small[:, 1:] > small[:, :-1]
+
+    def check(self, frame: SampledFrame) -> SampledFrame:
+        bits = self.dhash(frame.image)
+        if self._hash is not None and np.count_nonzero(bits != self._hash) <= self.max_distance:
+            frame.duplicate_of = self._index
+        else:
+            self._hash, self._index = bits, frame.index
+        return frame
+
+
+class SamplingClock:
+    """
+    Picks the first frame of every `every`-second bucket of a video and
+    its last frame, so every endpoint samples the same frames for the
+    same file and the tail of the video is covered. Frame indexes are
+    0-based, frame `i` shows second `i / fps`
+    """
+    def __init__(self, fps: float, every: float = 1.0, total_frames: int = 0):
+        self.fps = fps if fps and fps > 0 else DEFAULT_FPS
+        self.every = every
+        self.total_frames = total_frames
+        self._bucket = -1
+
+    def second(self, index: int) -> float:
+        return index / self.fps
+
+    def take(self, index: int) -> bool:
+        bucket = math.floor(index / self.fps / self.every)
+        if bucket == self._bucket:
+            return index == self.total_frames - 1
+        self._bucket = bucket
+        return True
+
+
+class FrameSource:
+    """
+    Iterates over sampled frames of a video.
+
+    Every frame is only grabbed (demuxed and decoded without
+    conversion), and `retrieve` together with the RGB conversion runs
+    for the frames picked by the sampling clock only. Picked frames
+    are downscaled to `output_size` before the color conversion.
+    Blank frames rejected by the `quality` filter are dropped, and with
+    a `gate_distance` repeats of the last distinct frame are yielded with
+    `duplicate_of` set.
+    """
+    def __init__(
+        self,
+        path: str,
+        every: float = 1.0,
+        short_side: int = 0,
+        gate_distance: int = FRAME_GATE_DISTANCE,
+        quality: FrameQualityFilter | None = None,
+    ):
+        self.path = path
+        self.every = every
+        self.short_side = short_side
+        self.gate_distance = gate_distance
+        self.quality = quality if quality is not None else FrameQualityFilter()
+        self.stats = FrameStats()
+
+        cap = cv2.VideoCapture(path)
+        self.fps = cap.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        self.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+
+    @property
+    def output_size(self) -> tuple[int, int]:
+        """
+        Size of yielded frames: the shorter side is scaled down to
+        `short_side` keeping aspect ratio, frames are never upscaled
+        """
+        width, height = self.width, self.height
+        short = min(width, height)
+        if not self.short_side or short <= self.short_side:
+            return width, height
+        scale = self.short_side / short
+        return max(2, round(width * scale / 2) * 2), max(2, round(height * scale / 2) * 2)
+
+    def _gated(self, frames: Iterator[SampledFrame]) -> Iterator[SampledFrame]:
+        if self.gate_distance < 0:
+            yield from frames
+            return
+
+        gate = FrameGate(self.gate_distance)
+        for frame in frames:
+            if gate.check(frame).duplicate_of is not None:
+                self.stats.gated += 1
+            yield frame
+
+    def _filtered(self, frames: Iterator[SampledFrame]) -> Iterator[SampledFrame]:
+        if not self.quality.enabled:
+            yield from frames
+            return
+
+        for frame in frames:
+            reason = self.quality.reject(frame.image)
+            if reason is not None:
+                self.stats.dropped[reason] = self.stats.dropped.get(reason, 0) + 1
+                continue
+            yield frame
+
+    def __iter__(self) -> Iterator[SampledFrame]:
+        frames = self._gated(self._filtered(self._frames()))
+        try:
+            while True:
+                start = time.perf_counter()
+                frame = next(frames, None)
+                self.stats.decode_s += time.perf_counter() - start
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            frames.close()
+
+    def _frames(self) -> Iterator[SampledFrame]:
+        clock = SamplingClock(self.fps, self.every, self.total_frames)
+        size = self.output_size
+        cap = cv2.VideoCapture(self.path)
+        try:
+            index = -1
+            while cap.grab():
+                index += 1
+                if not clock.take(index):
+                    self.stats.skipped += 1
+                    continue
+
+                ret, frame = cap.retrieve()
+                if not ret:
+                    self.stats.skipped += 1
+                    continue
+
+                self.stats.decoded += 1
+                if size != (frame.shape[1], frame.shape[0]):
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                yield SampledFrame(index, clock.second(index), Image.fromarray(frame))
+        finally:
+            cap.release()
+
+
+class FFmpegFrameSource(FrameSource):
+    """
+    Frame source backed by an `ffmpeg` pipe.
+
+    Sampling and scaling run inside the FFmpeg filter graph, so only
+    sampled frames are converted to RGB, and they leave the decoder at
+    `output_size` instead of the full resolution. The `select` filter
+    reproduces `SamplingClock` on the frame number. Rotation metadata is
+    applied, as the OpenCV reader does, so both yield the same pixels.
+    The number of every selected frame is set as its pts before the
+    `select` and read back from `showinfo`, so it does not depend on
+    the frame count the container reports.
+    """
+    def _command(self) -> list[str]:
+        width, height = self.output_size
+        step = self.fps * self.every
+        select = f'select=eq(n\\,0)+not(eq(floor(n/{step})\\,floor((n-1)/{step})))'
+        if self.total_frames > 0:
+            select += f'+eq(n\\,{self.total_frames - 1})'
+        return [
+            # `showinfo` logs at the info level
+            FFMPEG_BIN, '-hide_banner', '-nostats', '-v', 'info',
+            '-threads', str(FRAME_DECODE_THREADS),
+            '-i', self.path,
+            '-vf', f'setpts=N,{select},showinfo,scale={width}:{height}:flags=area',
+            '-vsync', '0',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1',
+        ]
+
+    def _frames(self) -> Iterator[SampledFrame]:
+        clock = SamplingClock(self.fps, self.every, self.total_frames)
+        width, height = self.output_size
+        frame_bytes = width * height * 3
+        # no video stream the probe could read, e.g. an audio-only file
+        if width <= 0 or height <= 0:
+            self.stats.skipped = self.total_frames
+            return
+
+        process = subprocess.Popen(self._command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=frame_bytes)
+        numbers: queue.Queue[int | None] = queue.Queue()
+
+        def read_numbers():
+            for line in process.stderr:
+                match = _SHOWINFO_PTS.search(line)
+                if match:
+                    numbers.put(int(match.group(1)))
+            numbers.put(None)
+
+        reader = threading.Thread(target=read_numbers, name='ffmpeg-showinfo', daemon=True)
+        reader.start()
+        try:
+            while True:
+                buffer = process.stdout.read(frame_bytes)
+                if len(buffer) < frame_bytes:
+                    break
+                # logged by `showinfo` before the frame is scaled and written
+                index = numbers.get()
+                if index is None:
+                    break
+                self.stats.decoded += 1
+                frame = np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+                yield SampledFrame(index, clock.second(index), Image.fromarray(frame))
+        finally:
+            process.kill()
+            process.wait()
+            reader.join()
+            self.stats.skipped = max(0, self.total_frames - self.stats.decoded)
+
+
+def make_frame_source(path: str, every: float = 1.0, short_side: int = 0) -> FrameSource:
+    if FRAME_DECODER == 'ffmpeg':
+        return FFmpegFrameSource(path, every, short_side)
+    return FrameSource(path, every, short_side)
@@ -0,0 +1,475 @@
+"""
+In-process vector store for single-node deployments, selected with `VSTORE=local`.
+
+Points live in append-only column files under `VSTORE_PATH`, read through
+memory maps, so the store is persisted as it is written and opened without
+loading it. Vectors are kept unit-normalized in float16, searches score by
+inner product, i.e. cosine similarity.
+
+    vectors.f16     float16 [rows, dim]
+    ids.S36         point ids, written last: their length is the committed row count
+    video_name.i32  codes into `names.jsonl`
+    video_id.i64, frame.i64, second.f32
+    deleted.i64     log of deleted rows
+
+Upserting a point id that exists appends the new row and logs the old one deleted.
+
+Up to `VSTORE_TRAIN_SIZE` rows are searched exactly. Past that a FAISS
+IVF-PQ index is trained in the background and kept up to date incrementally:
+new rows are added and deleted ones removed as other requests or worker
+processes write them. Its candidates are rescored exactly against the
+float16 vectors. The index is snapshotted next to the columns every
+`VSTORE_SNAPSHOT_ROWS` added rows, so a restart only catches up the rows
+written since. Writers of all processes are serialized by a file lock.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from .store import Hit, VectorStore, group_rounds
+
+# Rows searched exactly before an IVF-PQ index is trained
+VSTORE_TRAIN_SIZE = int(os.getenv('VSTORE_TRAIN_SIZE', 50_000))
+VSTORE_NLIST = int(os.getenv('VSTORE_NLIST', 1024))
+# PQ sub-quantizers, must divide the vector size: 64 stores 1024-d vectors in 64 bytes
+VSTORE_PQ_M = int(os.getenv('VSTORE_PQ_M', 64))
+VSTORE_NPROBE = int(os.getenv('VSTORE_NPROBE', 32))
+# IVF-PQ candidates rescored exactly per requested hit
+VSTORE_OVERSAMPLING = int(os.getenv('VSTORE_OVERSAMPLING', 16))
+# Hits fetched per requested hit when grouping by video, see `group_rounds`
+VSTORE_GROUP_OVERSAMPLING = int(os.getenv('VSTORE_GROUP_OVERSAMPLING', 4))
+# Filtered searches over at most this many rows are exact
+VSTORE_EXACT_ROWS = int(os.getenv('VSTORE_EXACT_ROWS', VSTORE_TRAIN_SIZE))
+VSTORE_SNAPSHOT_ROWS = int(os.getenv('VSTORE_SNAPSHOT_ROWS', 100_000))
+# FAISS search threads, `0` keeps the OpenMP default
+VSTORE_THREADS = int(os.getenv('VSTORE_THREADS', 0))
+
+_EXACT_CHUNK = 65_536
+# floats gathered per rescoring step
+_RESCORE_FLOATS = 1 << 24
+_COLUMNS = {
+    'video_name': ('video_name.i32', np.int32),
+    'video_id': ('video_id.i64', np.int64),
+    'frame': ('frame.i64', np.int64),
+    'second': ('second.f32', np.float32),
+}
+_ID = np.dtype('S36')
+
+logger = logging.getLogger('uvicorn')
+
+
+def _top(scores: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Best `k` columns of every query row, best first"""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(rows, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+class LocalStore(VectorStore):
+    name = 'local'
+
+    def __init__(self, path: str):
+        import faiss
+
+        self.faiss = faiss
+        if VSTORE_THREADS:
+            faiss.omp_set_num_threads(VSTORE_THREADS)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self.dim: int | None = None
+        self.rows = 0
+        self.vectors = np.empty((0, 0), dtype=np.float16)
+        self.point_ids = np.empty(0, dtype=_ID)
+        self.columns = {name: np.empty(0, dtype=dtype) for name, (_, dtype) in _COLUMNS.items()}
+        self.names: list[str] = []
+        self.codes: dict[str, int] = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.deleted = 0
+        self.index = None
+        self._indexed_rows = 0
+        self._indexed_deleted = 0
+        self._snapshot_rows = 0
+        self._trainer: threading.Thread | None = None
+        self._load_snapshot()
+        self._refresh()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _write_lock(self):
+        """Serializes writers across processes"""
+        with open(self._file('lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _committed_rows(self) -> int:
+        try:
+            return os.path.getsize(self._file('ids.S36')) // _ID.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def _map(self, name: str, dtype, rows: int, dim: int | None = None) -> np.ndarray:
+        shape = (rows,) if dim is None else (rows, dim)
+        if rows == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=shape)
+
+    def _read_meta(self):
+        if self.dim is None and os.path.exists(self._file('meta.json')):
+            with open(self._file('meta.json')) as f:
+                self.dim = json.load(f)['dim']
+
+    def _read_names(self):
+        try:
+            with open(self._file('names.jsonl')) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        for line in lines[len(self.names):]:
+            name = json.loads(line)
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+
+    def _refresh(self):
+        """Catches up with rows and deletions written since the last call, by any process"""
+        with self._lock:
+            self._read_meta()
+            rows = self._committed_rows()
+            if rows > self.rows:
+                self._read_names()
+                self.vectors = self._map('vectors.f16', np.float16, rows, self.dim)
+                self.point_ids = self._map('ids.S36', _ID, rows)
+                self.columns = {name: self._map(file, dtype, rows) for name, (file, dtype) in _COLUMNS.items()}
+                self.alive = np.concatenate([self.alive, np.ones(rows - self.rows, dtype=bool)])
+                self.rows = rows
+
+            try:
+                deleted = os.path.getsize(self._file('deleted.i64')) // 8
+            except FileNotFoundError:
+                deleted = 0
+            if deleted > self.deleted:
+                log = np.fromfile(self._file('deleted.i64'), dtype=np.int64, count=deleted)
+                self.alive[log[self.deleted:]] = False
+                self.deleted = deleted
+
+            self._update_index()
+
+    def _update_index(self):
+        if self.index is None:
+            if self.rows - self.deleted < VSTORE_TRAIN_SIZE:
+                return
+            # another process may have trained it already
+            self._load_snapshot()
+            if self.index is None:
+                if self._trainer is None:
+                    self._trainer = threading.Thread(target=self.build, name='vstore-train', daemon=True)
+                    self._trainer.start()
+                return
+        if self.rows > self._indexed_rows:
+            for start in range(self._indexed_rows, self.rows, _EXACT_CHUNK):
+                end = min(start + _EXACT_CHUNK, self.rows)
+                rows = np.arange(start, end)[self.alive[start:end]]
+                if len(rows):
+                    self.index.add_with_ids(np.asarray(self.vectors[rows], dtype=np.float32), rows)
+            self._indexed_rows = self.rows
+        if self.deleted > self._indexed_deleted:
+            log = np.fromfile(self._file('deleted.i64'), dtype=np.int64, count=self.deleted)
+            removed = log[self._indexed_deleted:]
+            self.index.remove_ids(self.faiss.IDSelectorBatch(len(removed), self.faiss.swig_ptr(removed)))
+            self._indexed_deleted = self.deleted
+        if self._indexed_rows - self._snapshot_rows >= VSTORE_SNAPSHOT_ROWS:
+            self.flush()
+
+    def build(self):
+        """
+        Trains the IVF-PQ index on a sample of the stored vectors and adds
+        them all. Runs in the background once the store outgrows exact
+        search, which serves searches meanwhile; one process trains, the
+        others load its snapshot
+        """
+        trainer = self._trainer
+        if trainer is not None and trainer is not threading.current_thread():
+            trainer.join()
+        faiss = self.faiss
+        with open(self._file('train.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                self._load_snapshot()
+                if self.index is not None:
+                    return
+                rows = np.flatnonzero(self.alive)
+                sample = np.sort(np.random.default_rng(0).choice(rows, min(len(rows), VSTORE_TRAIN_SIZE), replace=False))
+                nlist = max(1, min(VSTORE_NLIST, len(sample) // 39))
+                logger.info(f'Training IVF{nlist},PQ{VSTORE_PQ_M} on {len(sample)} of {len(rows)} vectors')
+                index = faiss.index_factory(self.dim, f'IVF{nlist},PQ{VSTORE_PQ_M}', faiss.METRIC_INNER_PRODUCT)
+                index.train(np.asarray(self.vectors[sample], dtype=np.float32))
+                with self._lock:
+                    # rows deleted so far are skipped while adding
+                    self.index = index
+                    self._indexed_rows = 0
+                    self._indexed_deleted = self.deleted
+                    self._update_index()
+                    self.flush()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                if self.index is None:
+                    # retried on the next refresh, should the process training it die
+                    self._trainer = None
+
+    def _load_snapshot(self):
+        if self.index is not None:
+            return
+        try:
+            snapshot = np.load(self._file('ivfpq.npz'))
+        except FileNotFoundError:
+            return
+        self.index = self.faiss.deserialize_index(snapshot['index'])
+        self._indexed_rows = self._snapshot_rows = int(snapshot['rows'])
+        self._indexed_deleted = int(snapshot['deleted'])
+
+    def flush(self):
+        """Snapshots the IVF-PQ index, rows written after it are added on load"""
+        with self._lock:
+            if self.index is None:
+                return
+            # the index and the rows it holds are replaced together
+            tmp = self._file(f'ivfpq.{os.getpid()}.npz')
+            np.savez(
+                tmp,
+                index=self.faiss.serialize_index(self.index),
+                rows=self._indexed_rows,
+                deleted=self._indexed_deleted,
+            )
+            os.replace(tmp, self._file('ivfpq.npz'))
+            self._snapshot_rows = self._indexed_rows
+
+    def _payload(self, row: int) -> dict:
+        return {
+            'video_name': self.names[self.columns['video_name'][row]],
+            'video_id': int(self.columns['video_id'][row]),
+            'frame': int(self.columns['frame'][row]),
+            'second': float(self.columns['second'][row]),
+        }
+
+    def _candidate_rows(self, total: int, video_names, exclude_video_names) -> np.ndarray | None:
+        """Rows of the first `total` a filtered search may return, `None` when all of them may"""
+        if not video_names and not exclude_video_names and self.deleted == 0:
+            return None
+        allowed = self.alive[:total].copy()
+        codes = self.columns['video_name'][:len(allowed)]
+        if video_names:
+            allowed &= np.isin(codes, [self.codes[name] for name in video_names if name in self.codes])
+        if exclude_video_names:
+            allowed &= ~np.isin(codes, [self.codes[name] for name in exclude_video_names if name in self.codes])
+        return np.flatnonzero(allowed)
+
+    def _exact(
+        self,
+        queries: np.ndarray,
+        k: int,
+        total: int,
+        rows: np.ndarray | None,
+        excluded: np.ndarray | None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Best `k` of the first `total` rows or of `rows`, leaving out the videos `excluded` per query"""
+        scores = np.empty((len(queries), 0), dtype=np.float32)
+        best = np.empty((len(queries), 0), dtype=np.int64)
+        if rows is not None:
+            total = len(rows)
+        for start in range(0, total, _EXACT_CHUNK):
+            if rows is None:
+                chunk = np.arange(start, min(start + _EXACT_CHUNK, total))
+                block = self.vectors[start:start + len(chunk)]
+            else:
+                chunk = rows[start:start + _EXACT_CHUNK]
+                block = self.vectors[chunk]
+            chunk_scores = queries @ np.asarray(block, dtype=np.float32).T
+            if excluded is not None:
+                chunk_scores[excluded[:, self.columns['video_name'][chunk]]] = -np.inf
+            scores, best = _top(
+                np.concatenate([scores, chunk_scores], axis=1),
+                np.concatenate([best, np.broadcast_to(chunk, chunk_scores.shape)], axis=1),
+                k,
+            )
+        return scores, best
+
+    def _ann(
+        self,
+        queries: np.ndarray,
+        k: int,
+        total: int,
+        rows: np.ndarray | None,
+        excluded: np.ndarray | None,
+        candidates: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        `candidates` IVF-PQ hits per query, of which the best `k * VSTORE_OVERSAMPLING`
+        outside the `excluded` videos are rescored exactly
+        """
+        faiss = self.faiss
+        params = faiss.SearchParametersIVF(nprobe=VSTORE_NPROBE)
+        if rows is not None:
+            bitmap = np.zeros(total, dtype=bool)
+            bitmap[rows] = True
+            # referenced until the search returns, the selector does not own it
+            bitmap = np.packbits(bitmap, bitorder='little')
+            params.sel = faiss.IDSelectorBitmap(len(bitmap) * 8, faiss.swig_ptr(bitmap))
+        with self._lock:
+            distances, found = self.index.search(queries, min(candidates, self.index.ntotal), params=params)
+
+        # rows added after the search started are left for the next one
+        found[found >= total] = -1
+        if excluded is not None:
+            valid = found >= 0
+            codes = np.zeros(found.shape, dtype=np.int64)
+            codes[valid] = self.columns['video_name'][found[valid]]
+            found[valid & np.take_along_axis(excluded, codes, axis=1)] = -1
+        distances[found < 0] = -np.inf
+        distances, found = _top(distances, found, k * VSTORE_OVERSAMPLING)
+
+        scores = np.full(found.shape, -np.inf, dtype=np.float32)
+        step = max(1, _RESCORE_FLOATS // (found.shape[1] * self.dim))
+        for start in range(0, len(queries), step):
+            chunk = found[start:start + step]
+            valid = chunk >= 0
+            vectors = np.zeros(chunk.shape + (self.dim,), dtype=np.float32)
+            vectors[valid] = self.vectors[chunk[valid]]
+            scores[start:start + step] = np.where(
+                valid, np.einsum('qd,qcd->qc', queries[start:start + step], vectors), -np.inf
+            )
+        return _top(scores, found, k)
+
+    def _nearest(
+        self,
+        queries: np.ndarray,
+        k: int,
+        total: int,
+        rows: np.ndarray | None,
+        excluded: np.ndarray | None = None,
+        widen: int = 0,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if self.index is None or (rows is not None and len(rows) <= VSTORE_EXACT_ROWS):
+            return self._exact(queries, k, total, rows, excluded)
+        # excluded videos take the best IVF-PQ hits, every round looks further
+        return self._ann(queries, k, total, rows, excluded, k * VSTORE_OVERSAMPLING * 4 ** widen)
+
+    def search(self, vectors, limit, group_by=None, group_size=1, video_names=None, exclude_video_names=None):
+        if group_by not in (None, 'video_name'):
+            raise ValueError(f'Local store only groups by video_name, not {group_by}')
+        self._refresh()
+        with self._lock:
+            total, videos = self.rows, len(self.names)
+        if total == 0:
+            return [[] for _ in vectors]
+
+        queries = np.asarray(vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        rows = self._candidate_rows(total, video_names, exclude_video_names)
+        if not group_by:
+            scores, best = self._nearest(queries, limit, total, rows)
+            return [
+                [
+                    Hit(self.point_ids[row].decode(), score, self._payload(row))
+                    for score, row in zip(query_scores.tolist(), query_rows.tolist())
+                    if row >= 0 and score != -np.inf
+                ]
+                for query_scores, query_rows in zip(scores, best)
+            ]
+
+        k = limit * group_size * VSTORE_GROUP_OVERSAMPLING
+
+        def search_round(widen, pending, keys):
+            excluded = None
+            if widen:
+                excluded = np.zeros((len(pending), videos), dtype=bool)
+                for j, codes in enumerate(keys):
+                    excluded[j, codes] = True
+            scores, best = self._nearest(queries[pending], k, total, rows, excluded, widen)
+            return [
+                [
+                    Hit(self.point_ids[row].decode(), score, self._payload(row))
+                    for score, row in zip(query_scores.tolist(), query_rows.tolist())
+                    if row >= 0 and score != -np.inf
+                ]
+                for query_scores, query_rows in zip(scores, best)
+            ]
+
+        return group_rounds(
+            len(queries), search_round, lambda hit: self.codes[hit.payload['video_name']], limit, group_size
+        )
+
+    def upsert(self, ids, vectors, payloads):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = (vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)).astype(np.float16)
+        point_ids = np.array([str(point_id).encode() for point_id in ids], dtype=_ID)
+        with self._write_lock():
+            self._read_meta()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self._file('meta.json'), 'w') as f:
+                    json.dump({'dim': self.dim}, f)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f'Vector size {vectors.shape[1]} does not match the store ({self.dim})')
+
+            # rows of a writer that died before committing its ids are dropped
+            rows = self._committed_rows()
+            for file, itemsize in [('vectors.f16', 2 * self.dim)] + [(file, np.dtype(dtype).itemsize) for file, dtype in _COLUMNS.values()]:
+                if os.path.exists(self._file(file)) and os.path.getsize(self._file(file)) > rows * itemsize:
+                    os.truncate(self._file(file), rows * itemsize)
+
+            self._read_names()
+            new_names = list(dict.fromkeys(p['video_name'] for p in payloads if p['video_name'] not in self.codes))
+            if new_names:
+                with open(self._file('names.jsonl'), 'a') as f:
+                    f.writelines(json.dumps(name) + '\n' for name in new_names)
+                self._read_names()
+
+            columns = {
+                'vectors.f16': vectors,
+                'video_name.i32': np.array([self.codes[p['video_name']] for p in payloads], dtype=np.int32),
+                'video_id.i64': np.array([p['video_id'] for p in payloads], dtype=np.int64),
+                'frame.i64': np.array([p['frame'] for p in payloads], dtype=np.int64),
+                'second.f32': np.array([p['second'] for p in payloads], dtype=np.float32),
+                # last, commits the rows
+                'ids.S36': point_ids,
+            }
+            self._refresh()
+            replaced = np.flatnonzero(np.isin(self.point_ids[:self.rows], point_ids) & self.alive[:self.rows])
+            for file, column in columns.items():
+                with open(self._file(file), 'ab') as f:
+                    f.write(column.tobytes())
+            # after the commit, a writer dying in between leaves both rows rather than none
+            if len(replaced):
+                with open(self._file('deleted.i64'), 'ab') as f:
+                    f.write(replaced.astype(np.int64).tobytes())
+        self._refresh()
+
+    def delete_video(self, video_name, keep_ids=None):
+        with self._write_lock():
+            self._refresh()
+            code = self.codes.get(video_name)
+            if code is None:
+                return
+            doomed = (self.columns['video_name'][:self.rows] == code) & self.alive
+            if keep_ids:
+                doomed &= ~np.isin(self.point_ids[:self.rows], np.array([str(i).encode() for i in keep_ids], dtype=_ID))
+            rows = np.flatnonzero(doomed)
+            with open(self._file('deleted.i64'), 'ab') as f:
+                f.write(rows.astype(np.int64).tobytes())
+        self._refresh()
@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+
+import numpy as np
+
+# Empty disables the matrices and with them exact verification
+VIDEO_MATRIX_DIR = os.getenv('VIDEO_MATRIX_DIR', '')
+# Source frames multiplied per matrix product
+_CHUNK = 16_384
+
+logger = logging.getLogger('uvicorn')
+
+
+@dataclass
+class VideoMatrix:
+    # unit-normalized float16 [frames, dim], memory-mapped
+    vectors: np.ndarray
+    frames: np.ndarray
+    seconds: np.ndarray
+
+
+class VideoMatrices:
+    """
+    Frame embedding matrices of the indexed source videos, keyed by `video_name`.
+
+    Written by `/index` next to the vector store upsert. Vectors are stored
+    unit-normalized in float16 as `.npy` and memory-mapped on read, frame
+    numbers and seconds as `.npz`. Moderation uses them to verify the source
+    videos the vector search nominates with exact cosine similarities.
+    Reindexing a video replaces its matrix atomically: every version is a
+    directory of its own and the path of the video a symlink to the
+    current one, renamed over the old link, so readers see either version
+    whole. Compute `/delete` removes the matrix with the points of the video
+    """
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, video_name: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(video_name.encode()).hexdigest())
+
+    def get(self, video_name: str) -> VideoMatrix | None:
+        path = self._path(video_name)
+        # a version replaced between resolving the link and reading it is gone, read the new one
+        for _ in range(3):
+            version = os.path.realpath(path)
+            try:
+                vectors = np.load(os.path.join(version, 'vectors.npy'), mmap_mode='r')
+                with np.load(os.path.join(version, 'meta.npz')) as meta:
+                    return VideoMatrix(vectors, meta['frame'], meta['second'])
+            except FileNotFoundError:
+                if os.path.realpath(path) == version:
+                    return None
+            except (ValueError, OSError):
+                return None
+        return None
+
+    def put(self, video_name: str, vectors: np.ndarray, frames: np.ndarray, seconds: np.ndarray):
+        """Replaces the matrix of the video"""
+        path = self._path(video_name)
+        version = os.path.join(self.root, f'.{os.path.basename(path)}.{uuid.uuid4().hex}')
+        os.makedirs(version)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        try:
+            np.save(os.path.join(version, 'vectors.npy'), vectors.astype(np.float16))
+            np.savez(os.path.join(version, 'meta.npz'), frame=np.asarray(frames, dtype=np.int64), second=np.asarray(seconds, dtype=np.float32))
+            old = os.path.realpath(path) if os.path.lexists(path) else None
+            if old == path:
+                # a directory written before versions, readers miss it until the link is in place
+                old = f'{version}.old'
+                os.rename(path, old)
+            link = f'{version}.link'
+            os.symlink(os.path.basename(version), link)
+            # renaming over the old link, readers see either version whole
+            os.replace(link, path)
+            if old:
+                shutil.rmtree(old, ignore_errors=True)
+        except OSError:
+            shutil.rmtree(version, ignore_errors=True)
+            logger.exception(f'Could not write the frame matrix of {video_name}')
+
+    def delete(self, video_name: str):
+        path = self._path(video_name)
+        if not os.path.lexists(path):
+            return
+        version = os.path.realpath(path)
+        if os.path.islink(path):
+            os.unlink(path)
+        shutil.rmtree(version, ignore_errors=True)
+
+    def best_matches(self, points: np.ndarray, video_name: str) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        Exact best cosine similarity of every probe vector against the frames
+        of the video and the second of the best frame, `None` without a matrix
+        """
+        matrix = self.get(video_name)
+        if matrix is None or len(matrix.vectors) == 0:
+            return None
+        points = np.asarray(points, dtype=np.float32)
+        points = points / np.maximum(np.linalg.norm(points, axis=1, keepdims=True), 1e-12)
+        scores = np.full(len(points), -np.inf, dtype=np.float32)
+        best = np.zeros(len(points), dtype=np.int64)
+        for start in range(0, len(matrix.vectors), _CHUNK):
+            similarity = points @ np.asarray(matrix.vectors[start:start + _CHUNK], dtype=np.float32).T
+            chunk_best = similarity.argmax(axis=1)
+            chunk_scores = similarity[np.arange(len(points)), chunk_best]
+            better = chunk_scores > scores
+            scores[better] = chunk_scores[better]
+            best[better] = chunk_best[better] + start
+        return scores, matrix.seconds[best]
+
+
+matrices = VideoMatrices(VIDEO_MATRIX_DIR) if VIDEO_MATRIX_DIR else None
@@ -0,0 +1,59 @@
+import os
+import resource
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from .frames import FrameStats
+
+# Set for forked workers (`vector.serve`), every worker writes its samples there
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+_LATENCY = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+_REQUEST = (1., 5., 10., 30., 60., 120., 300., 600., 1200., 3600.)
+
+REQUESTS_IN_FLIGHT = Gauge(
+    'compute_requests_in_flight', 'Requests being processed', ['endpoint'], multiprocess_mode='livesum'
+)
+REQUEST_SECONDS = Histogram('compute_request_seconds', 'Request latency', ['endpoint'], buckets=_REQUEST)
+FRAMES = Counter(
+    'compute_frames_total',
+    'Video frames by outcome: sampled (embedded or gated), skipped by the sampling clock, gated as repeats, dropped as blank',
+    ['outcome'],
+)
+PREPROCESS_SECONDS = Histogram('compute_preprocess_seconds', 'Preprocessing time per inference batch', buckets=_LATENCY)
+INFERENCE_SECONDS = Histogram('compute_inference_seconds', 'Model time per inference batch', buckets=_LATENCY)
+INFERENCE_BATCH_SIZE = Histogram(
+    'compute_inference_batch_size', 'Images per inference batch', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+VECTOR_STORE_SECONDS = Histogram(
+    'compute_vector_store_seconds', 'Vector store call latency', ['backend', 'operation'], buckets=_LATENCY
+)
+VERIFY_SECONDS = Histogram('compute_verify_seconds', 'Exact verification time per request', buckets=_LATENCY)
+VIOLATIONS_SECONDS = Histogram('compute_violations_seconds', 'Violation clustering time per request', buckets=_LATENCY)
+MAX_RSS_BYTES = Gauge('compute_max_rss_bytes', 'Peak resident memory of the process', multiprocess_mode='max')
+
+
+def observe_frames(stats: FrameStats):
+    FRAMES.labels('sampled').inc(stats.decoded)
+    FRAMES.labels('skipped').inc(stats.skipped)
+    FRAMES.labels('gated').inc(stats.gated)
+    FRAMES.labels('dropped').inc(sum(stats.dropped.values()))
+
+
+def render() -> tuple[bytes, str]:
+    """Exposition of all metrics, merged over workers in multiprocess mode"""
+    MAX_RSS_BYTES.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,188 @@
+import glob
+import logging
+import os
+import time
+from typing import Iterable
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .base import BaseImageEmbedder
+from .preprocess import BatchImagePreprocessor
+from .patches import BOX, get_token_slices
+from transformers import AutoConfig, AutoModel, AutoProcessor
+
+ONNX_CACHE_DIR = os.getenv('VONNX_CACHE', os.path.expanduser('~/.cache/copyright/onnx'))
+# Directory of images used to calibrate static int8 quantization
+VQUANT_CALIBRATION_DIR = os.getenv('VQUANT_CALIBRATION_DIR')
+
+logger = logging.getLogger('uvicorn')
+
+
+class _HiddenState(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).last_hidden_state
+
+
+class _CalibrationReader:
+    def __init__(self, pixel_values, paths: list[str], batch_size: int = 8):
+        self._batches = iter([
+            {'pixel_values': pixel_values([Image.open(p).convert('RGB') for p in paths[i:i + batch_size]])}
+            for i in range(0, len(paths), batch_size)
+        ])
+
+    def get_next(self):
+        return next(self._batches, None)
+
+
+class OnnxImageEmbedder(BaseImageEmbedder):
+    """
+    Image embedder running an ONNX export of a HF vision transformer
+    through ONNX Runtime.
+
+    The model is exported once into `ONNX_CACHE_DIR` and optionally
+    quantized to int8: `dynamic` quantizes weights only, `static` also
+    quantizes activations using images from `VQUANT_CALIBRATION_DIR`.
+    `provider='openvino'` runs the graph with the OpenVINO execution
+    provider (`onnxruntime-openvino` package).
+    """
+    def __init__(self, model_name: str, quantize: str = 'none', provider: str = 'cpu', threads: int | None = None):
+        import onnxruntime as ort
+
+        self.device = 'cpu'
+        self.processor = AutoProcessor.from_pretrained(model_name)
+        self.preprocess = BatchImagePreprocessor.from_processor(self.processor)
+        # whole frames of region pooling have no HF counterpart to match
+        self.frame_preprocess = BatchImagePreprocessor.from_processor(self.processor, exact=False)
+        if self.frame_preprocess is None:
+            raise ValueError(f'{type(self.processor).__name__} is not supported by the ONNX backend')
+        config = AutoConfig.from_pretrained(model_name)
+        config = getattr(config, 'vision_config', config)
+        # CLS and register tokens precede the patch tokens, as in `VitImageEmbedder`
+        self.skip = 1 + getattr(config, 'num_register_tokens', 0)
+        self.patch_size = config.patch_size
+
+        path = self._export(model_name)
+        if quantize != 'none':
+            path = self._quantize(path, quantize)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+
+        providers = ['CPUExecutionProvider']
+        if provider == 'openvino':
+            if 'OpenVINOExecutionProvider' not in ort.get_available_providers():
+                raise RuntimeError('OpenVINOExecutionProvider is not available, install onnxruntime-openvino')
+            providers.insert(0, 'OpenVINOExecutionProvider')
+
+        self.session = ort.InferenceSession(path, options, providers=providers)
+
+    def _export(self, model_name: str) -> str:
+        folder = os.path.join(ONNX_CACHE_DIR, model_name.replace('/', '__'))
+        # height and width are dynamic, region pooling runs whole frames
+        path = os.path.join(folder, 'model-hw.onnx')
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(folder, exist_ok=True)
+        model = AutoModel.from_pretrained(model_name).eval()
+        # a 16:9 frame, so the position embeddings are traced interpolating
+        width, height = self.frame_preprocess.frame_size(16 * self.input_side, 9 * self.input_side, self.patch_size)
+        dummy = torch.zeros(1, 3, height, width)
+        logger.info(f'Exporting {model_name} to {path}')
+        with torch.no_grad():
+            torch.onnx.export(
+                _HiddenState(model),
+                (dummy,),
+                path + '.tmp',
+                input_names=['pixel_values'],
+                output_names=['last_hidden_state'],
+                dynamic_axes={
+                    'pixel_values': {0: 'batch', 2: 'height', 3: 'width'},
+                    'last_hidden_state': {0: 'batch', 1: 'tokens'},
+                },
+                opset_version=17,
+            )
+        os.replace(path + '.tmp', path)
+        return path
+
+    def _quantize(self, path: str, mode: str) -> str:
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+        output = path.replace('.onnx', f'.{mode}-int8.onnx')
+        if os.path.exists(output):
+            return output
+
+        logger.info(f'Quantizing {path} ({mode}) to {output}')
+        if mode == 'dynamic':
+            quantize_dynamic(path, output + '.tmp', weight_type=QuantType.QInt8)
+        elif mode == 'static':
+            if not VQUANT_CALIBRATION_DIR:
+                raise ValueError('Static quantization requires VQUANT_CALIBRATION_DIR')
+            paths = sorted(
+                p for p in glob.glob(os.path.join(VQUANT_CALIBRATION_DIR, '*'))
+                if p.lower().endswith(('.jpg', '.jpeg', '.png'))
+            )
+            if not paths:
+                raise ValueError(f'Static quantization found no .jpg or .png calibration images in {VQUANT_CALIBRATION_DIR}')
+            quantize_static(
+                path,
+                output + '.tmp',
+                _CalibrationReader(self._pixel_values, paths),
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                weight_type=QuantType.QInt8,
+            )
+        else:
+            raise ValueError(f'Unknown quantization mode: {mode}')
+        os.replace(output + '.tmp', output)
+        return output
+
+    def _pixel_values(self, images) -> np.ndarray:
+        if self.preprocess is not None:
+            return self.preprocess(images).numpy()
+        # fast processors batch themselves, their output differs from `BatchImagePreprocessor`
+        return self.processor(images=list(images), return_tensors='np')['pixel_values'].astype(np.float32)
+
+    def _hidden_state(self, images) -> np.ndarray:
+        start = time.perf_counter()
+        pixel_values = self._pixel_values(images)
+        self.preprocess_s += time.perf_counter() - start
+        start = time.perf_counter()
+        hidden = self.session.run(['last_hidden_state'], {'pixel_values': pixel_values})[0]
+        self.inference_s += time.perf_counter() - start
+        return hidden
+
+    def vectorize_array(self, *images: Image.Image, batch_size: int, dtype: np.dtype = np.float32) -> Iterable[np.ndarray]:
+        for i in range(0, len(images), batch_size):
+            hidden = self._hidden_state(images[i:i + batch_size])
+            yield np.ascontiguousarray(hidden[:, 0], dtype=dtype)
+
+    def vectorize_regions(self, *images: Image.Image, boxes: list[BOX], batch_size: int, dtype: np.dtype = np.float32) -> Iterable[np.ndarray]:
+        """Same as `VitImageEmbedder.vectorize_regions`"""
+        for i in range(0, len(images), batch_size):
+            start = time.perf_counter()
+            groups = list(self.frame_preprocess.frames(images[i:i + batch_size], self.patch_size))
+            self.preprocess_s += time.perf_counter() - start
+            start = time.perf_counter()
+            embeddings = [None] * sum(len(indices) for indices, _ in groups)
+            for indices, pixel_values in groups:
+                hidden = self.session.run(['last_hidden_state'], {'pixel_values': pixel_values.numpy()})[0]
+                height = pixel_values.shape[2] // self.patch_size
+                width = pixel_values.shape[3] // self.patch_size
+                tokens = hidden[:, self.skip:].reshape(hidden.shape[0], height, width, hidden.shape[-1])
+                regions = [
+                    tokens[:, rows, cols].mean(axis=(1, 2))
+                    for rows, cols in get_token_slices(boxes, height, width)
+                ]
+                regions.append(hidden[:, 0])
+                for j, image_regions in zip(indices, np.stack(regions, axis=1)):
+                    embeddings[j] = image_regions
+            self.inference_s += time.perf_counter() - start
+            yield np.ascontiguousarray(np.stack(embeddings), dtype=dtype)
@@ -0,0 +1,70 @@
+from PIL import Image
+
+BOX = tuple[float, float, float, float]
+
+
+def get_patches(image : Image.Image, grid_size: int) -> list[tuple[BOX, Image.Image]]:
+    width, height = image.size
+    patch_width = width // grid_size
+    patch_height = height // grid_size
+    
+    patches = []
+    for i in range(grid_size):
+        for j in range(grid_size):
+            left = i * patch_width
+            upper = j * patch_height
+            right = left + patch_width
+            lower = upper + patch_height
+            patch = image.crop((left, upper, right, lower))
+            patches.append(((left / width, upper / height, right / width, lower / height), patch))
+                        
+    return patches
+
+
+def get_overlay_patches(image: Image.Image, grid_size: int, cpr: float) -> list[tuple[BOX, Image.Image]]:
+    width, height = image.size
+    patch_width = width // grid_size
+    patch_height = height // grid_size
+    
+    patches = []
+    i, j = 0, 0
+    while i + patch_width * .5 <= width:
+        while j + patch_height * .5 <= height:
+            left = i
+            upper = j
+            right = left + patch_width 
+            lower = upper + patch_height
+            patch = image.crop((left, upper, right, lower))
+            patches.append(((left / width, upper / height, right / width, lower / height), patch))
+            j += int(patch_height * cpr)
+        i += int(patch_width * cpr)
+        j = 0
+        
+    return patches
+
+
+def get_grid_boxes(grid_size: int, cpr: float = 1.) -> list[BOX]:
+    """
+    Normalized boxes of the regions `get_patches` (cpr == 1) and
+    `get_overlay_patches` cut, in the same order
+    """
+    step = 1 / grid_size
+    boxes = []
+    i = 0.
+    while i + step * .5 <= 1:
+        j = 0.
+        while j + step * .5 <= 1:
+            boxes.append((i, j, min(i + step, 1.), min(j + step, 1.)))
+            j += step * cpr
+        i += step * cpr
+    return boxes
+
+
+def get_token_slices(boxes: list[BOX], height: int, width: int) -> list[tuple[slice, slice]]:
+    """Maps normalized boxes onto `(rows, cols)` slices of a `height x width` patch token grid"""
+    slices = []
+    for left, upper, right, lower in boxes:
+        x0, y0 = int(left * width), int(upper * height)
+        x1, y1 = max(x0 + 1, round(right * width)), max(y0 + 1, round(lower * height))
+        slices.append((slice(y0, y1), slice(x0, x1)))
+    return slices
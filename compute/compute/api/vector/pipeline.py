@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy: float = 0.
+    blocked_in: float = 0.
+    blocked_out: float = 0.
+    max_queue_depth: int = 0
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            f'{self.name}_items': self.items,
+            f'{self.name}_busy_s': round(self.busy, 3),
+            f'{self.name}_blocked_in_s': round(self.blocked_in, 3),
+            f'{self.name}_blocked_out_s': round(self.blocked_out, 3),
+            f'{self.name}_max_queue_depth': self.max_queue_depth,
+        }
+
+
+class _Stage:
+    def __init__(self, name: str, fn: Callable[[Any], Any] | None, source: Iterable | None = None):
+        self.name = name
+        self.fn = fn
+        self.source = source
+        self.stats = StageStats(name)
+        self.input: queue.Queue | None = None
+        self.output: queue.Queue | None = None
+
+    def _put(self, item, stop: threading.Event) -> bool:
+        t = time.perf_counter()
+        while not stop.is_set():
+            try:
+                self.output.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.stats.blocked_out += time.perf_counter() - t
+        return not stop.is_set()
+
+    def _get(self, stop: threading.Event):
+        t = time.perf_counter()
+        item = _DONE
+        while not stop.is_set():
+            try:
+                item = self.input.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        self.stats.blocked_in += time.perf_counter() - t
+        return item
+
+    def _items(self, stop: threading.Event) -> Iterator:
+        if self.source is not None:
+            iterator = iter(self.source)
+            while True:
+                t = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.stats.busy += time.perf_counter() - t
+                yield item
+
+        while True:
+            item = self._get(stop)
+            self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.input.qsize() + 1)
+            if item is _DONE or isinstance(item, _Failure):
+                self._forward = item
+                return
+            t = time.perf_counter()
+            result = self.fn(item)
+            self.stats.busy += time.perf_counter() - t
+            yield result
+
+    def run(self, stop: threading.Event):
+        self._forward = _DONE
+        try:
+            for item in self._items(stop):
+                self.stats.items += 1
+                if not self._put(item, stop):
+                    return
+        except BaseException as e:
+            self._forward = _Failure(e)
+        self._put(self._forward, stop)
+
+
+class Pipeline:
+    """
+    Bounded-queue pipeline where every stage runs in its own thread.
+
+    Consecutive stages are connected with queues of `maxsize` items,
+    so a slow stage applies back pressure instead of letting the
+    previous one buffer the whole video. Iterating over the pipeline
+    yields outputs of the last stage; the first error raised by any
+    stage is re-raised in the consumer.
+    """
+    def __init__(self, name: str, source: Iterable, maxsize: int = 2):
+        self.maxsize = maxsize
+        self._stages = [_Stage(name, None, source=source)]
+        self._stop = threading.Event()
+
+    def then(self, name: str, fn: Callable[[Any], Any]) -> 'Pipeline':
+        self._stages.append(_Stage(name, fn))
+        return self
+
+    def __iter__(self) -> Iterator:
+        for prev, stage in zip(self._stages, self._stages[1:]):
+            prev.output = queue.Queue(self.maxsize)
+            stage.input = prev.output
+        last = self._stages[-1]
+        last.output = queue.Queue(self.maxsize)
+
+        threads = [
+            threading.Thread(target=stage.run, args=(self._stop,), name=f'pipeline-{stage.name}', daemon=True)
+            for stage in self._stages
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = last.output.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+    def stats(self) -> dict[str, int | float]:
+        stats = {}
+        for stage in self._stages:
+            stats.update(stage.stats.as_dict())
+        return stats
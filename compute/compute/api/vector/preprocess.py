@@ -0,0 +1,159 @@
+from typing import Iterator, Sequence
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def _is_pil(processor) -> bool:
+    """Whether a HF image processor resizes with PIL rather than torchvision"""
+    backend = getattr(processor, 'backend', None)
+    if backend is not None:
+        return backend == 'pil'
+    return not type(processor).__name__.endswith('Fast')
+
+
+class BatchImagePreprocessor:
+    """
+    Batched replacement for HF resize -> center crop -> rescale -> normalize
+    image processors (DINOv2, ViT, CLIP).
+
+    Images are resized one by one with PIL exactly like the PIL HF
+    processor does and written into one preallocated uint8 batch;
+    rescaling and normalization then run over the whole batch at once.
+    Since inputs are uint8, rescale + normalize is precomputed as a
+    per-channel lookup table with the same float64 -> float32 steps the
+    HF processor takes, so the output matches it exactly. Fast
+    (torchvision) processors resize differently, their output is not
+    reproduced.
+    """
+    def __init__(
+        self,
+        size: dict[str, int],
+        crop_size: dict[str, int] | None,
+        image_mean: Sequence[float],
+        image_std: Sequence[float],
+        rescale_factor: float = 1 / 255,
+        resample: int = Image.BICUBIC,
+    ):
+        self.size = size
+        self.crop_size = crop_size
+        self.rescale_factor = rescale_factor
+        self.resample = resample
+        rescaled = (np.arange(256, dtype=np.float64) * rescale_factor).astype(np.float32)
+        mean = np.asarray(image_mean, dtype=np.float32)[:, None]
+        std = np.asarray(image_std, dtype=np.float32)[:, None]
+        self.table = (rescaled[None, :] - mean) / std
+
+    @classmethod
+    def from_processor(cls, processor, exact: bool = True) -> 'BatchImagePreprocessor | None':
+        """
+        Builds the preprocessor from a HF image processor, `None` if its
+        pipeline is not supported, or with `exact` if it is not a PIL
+        processor whose output this one matches
+        """
+        processor = getattr(processor, 'image_processor', processor)
+        size = getattr(processor, 'size', None)
+        if (
+            (exact and not _is_pil(processor))
+            or not size
+            or getattr(processor, 'crop_pct', None) is not None
+            or not getattr(processor, 'do_resize', False)
+            or not getattr(processor, 'do_rescale', False)
+            or not getattr(processor, 'do_normalize', False)
+            or not ('shortest_edge' in size or ('height' in size and 'width' in size))
+            or ('shortest_edge' in size and not getattr(processor, 'do_center_crop', False))
+        ):
+            return None
+
+        return cls(
+            size=dict(size),
+            crop_size=dict(processor.crop_size) if getattr(processor, 'do_center_crop', False) else None,
+            image_mean=processor.image_mean,
+            image_std=processor.image_std,
+            rescale_factor=processor.rescale_factor,
+            resample=processor.resample,
+        )
+
+    def _resized_size(self, width: int, height: int) -> tuple[int, int]:
+        if 'shortest_edge' not in self.size:
+            return self.size['width'], self.size['height']
+        short, long = (width, height) if width <= height else (height, width)
+        new_short = self.size['shortest_edge']
+        new_long = int(new_short * long / short)
+        return (new_short, new_long) if width <= height else (new_long, new_short)
+
+    def output_size(self, width: int, height: int) -> tuple[int, int]:
+        if self.crop_size is not None:
+            return self.crop_size['width'], self.crop_size['height']
+        return self._resized_size(width, height)
+
+    def frame_size(self, width: int, height: int, patch_size: int) -> tuple[int, int]:
+        """
+        Size a whole image is resized to instead of being center cropped:
+        the shorter side at the side of the model input, the aspect ratio
+        kept, both sides rounded to multiples of `patch_size`
+        """
+        if self.crop_size is not None:
+            side = min(self.crop_size['height'], self.crop_size['width'])
+        else:
+            side = self.size.get('shortest_edge') or min(self.size['height'], self.size['width'])
+        short, long = (width, height) if width <= height else (height, width)
+        new_short = max(patch_size, side // patch_size * patch_size)
+        new_long = max(patch_size, round(side * long / short / patch_size) * patch_size)
+        return (new_short, new_long) if width <= height else (new_long, new_short)
+
+    def _resize_crop(self, image: Image.Image, out: np.ndarray):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = image.resize(self._resized_size(*image.size), resample=self.resample)
+        array = np.asarray(image)
+        if self.crop_size is not None:
+            crop_h, crop_w = self.crop_size['height'], self.crop_size['width']
+            top = (array.shape[0] - crop_h) // 2
+            left = (array.shape[1] - crop_w) // 2
+            array = array[top:top + crop_h, left:left + crop_w]
+        out[...] = array
+
+    def _normalize(self, batch: np.ndarray, device: str) -> torch.Tensor:
+        pixels = np.empty((batch.shape[0], 3, batch.shape[1], batch.shape[2]), dtype=np.float32)
+        for c in range(3):
+            pixels[:, c] = self.table[c][batch[..., c]]
+        return torch.from_numpy(pixels).to(device)
+
+    def __call__(self, images: Sequence[Image.Image | np.ndarray], device: str = 'cpu') -> torch.Tensor:
+        """Turns RGB images (PIL or uint8 HWC arrays) into one normalized NCHW float32 batch"""
+        images = [
+            Image.fromarray(image) if isinstance(image, np.ndarray) else image
+            for image in images
+        ]
+        width, height = self.output_size(*images[0].size)
+        batch = np.empty((len(images), height, width, 3), dtype=np.uint8)
+        for image, out in zip(images, batch):
+            self._resize_crop(image, out)
+        return self._normalize(batch, device)
+
+    def frames(
+        self,
+        images: Sequence[Image.Image | np.ndarray],
+        patch_size: int,
+        device: str = 'cpu',
+    ) -> Iterator[tuple[list[int], torch.Tensor]]:
+        """
+        Whole images resized to `frame_size`, for models that interpolate
+        their position embeddings. Yields the indices of the images of every
+        output size with their normalized NCHW float32 batch
+        """
+        images = [
+            Image.fromarray(image) if isinstance(image, np.ndarray) else image
+            for image in images
+        ]
+        sizes: dict[tuple[int, int], list[int]] = {}
+        for i, image in enumerate(images):
+            sizes.setdefault(self.frame_size(*image.size, patch_size), []).append(i)
+        for (width, height), indices in sizes.items():
+            batch = np.empty((len(indices), height, width, 3), dtype=np.uint8)
+            for i, out in zip(indices, batch):
+                image = images[i] if images[i].mode == 'RGB' else images[i].convert('RGB')
+                out[...] = np.asarray(image.resize((width, height), resample=self.resample))
+            yield indices, self._normalize(batch, device)
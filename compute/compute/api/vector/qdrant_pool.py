@@ -0,0 +1,303 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+import numpy as np
+from qdrant_client import AsyncQdrantClient, QdrantClient, grpc, models
+from qdrant_client.conversions.conversion import GrpcToRest, RestToGrpc
+
+# gRPC keeps one multiplexed HTTP/2 connection per endpoint and sends vectors as packed floats.
+# Off by default: the compose files publish only the REST port, enable once QDRANT_GRPC_PORT is reachable
+QDRANT_PREFER_GRPC = os.getenv('QDRANT_PREFER_GRPC', '0') == '1'
+QDRANT_GRPC_PORT = int(os.getenv('QDRANT_GRPC_PORT', 6334))
+QDRANT_TIMEOUT = int(os.getenv('QDRANT_TIMEOUT', 60))
+# Search batches longer than this are split into sub-requests sent concurrently
+QDRANT_SEARCH_CHUNK = int(os.getenv('QDRANT_SEARCH_CHUNK', 64))
+QDRANT_SEARCH_CONCURRENCY = int(os.getenv('QDRANT_SEARCH_CONCURRENCY', 4))
+# Grouped searches take one query each, this many are in flight per search batch
+QDRANT_GROUP_CONCURRENCY = int(os.getenv('QDRANT_GROUP_CONCURRENCY', 32))
+
+_GRPC_OPTIONS = {
+    'grpc.keepalive_time_ms': 30_000,
+    'grpc.keepalive_timeout_ms': 10_000,
+    'grpc.keepalive_permit_without_calls': 1,
+    'grpc.max_send_message_length': 64 * 1024 ** 2,
+    'grpc.max_receive_message_length': 64 * 1024 ** 2,
+}
+
+_clients: dict['QdrantEndpoint', QdrantClient] = {}
+# only touched from the event loop thread
+_async_clients: dict['QdrantEndpoint', AsyncQdrantClient] = {}
+_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _options(endpoint: 'QdrantEndpoint') -> dict:
+    return dict(
+        api_key=endpoint.api_key or None,
+        port=endpoint.port,
+        grpc_port=QDRANT_GRPC_PORT,
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        timeout=QDRANT_TIMEOUT,
+        grpc_options=_GRPC_OPTIONS,
+    )
+
+
+@dataclass(frozen=True)
+class Query:
+    """Search parameters shared by the vectors of a batch"""
+    limit: int
+    filter: models.Filter | None = None
+    params: models.SearchParams | None = None
+    with_payload: models.PayloadSelector | bool = True
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _packed_floats(field: int, vector: np.ndarray) -> bytes:
+    """
+    Protobuf encoding of a packed repeated float field, taken straight
+    from the buffer of the vector instead of a Python float per component
+    """
+    data = np.ascontiguousarray(vector, dtype='<f4').tobytes()
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+
+def _grpc_queries(message, vectors: np.ndarray, query: Query, filters: list | None = None, **fields) -> list:
+    """
+    gRPC search messages of `message` type for the vectors, its `vector`
+    field set from their buffers. `filters` replace the filter of the query
+    per vector
+    """
+    template = message(
+        limit=query.limit,
+        filter=RestToGrpc.convert_filter(query.filter) if query.filter else None,
+        params=RestToGrpc.convert_search_params(query.params) if query.params else None,
+        with_payload=RestToGrpc.convert_with_payload_interface(query.with_payload),
+        **fields,
+    )
+    field = message.DESCRIPTOR.fields_by_name['vector'].number
+    messages = []
+    for i, vector in enumerate(vectors):
+        request = message()
+        request.CopyFrom(template)
+        if filters is not None:
+            request.ClearField('filter')
+            if filters[i] is not None:
+                request.filter.CopyFrom(RestToGrpc.convert_filter(filters[i]))
+        request.MergeFromString(_packed_floats(field, vector))
+        messages.append(request)
+    return messages
+
+
+def _rest_queries(vectors: np.ndarray, query: Query, filters: list | None = None) -> list[models.SearchRequest]:
+    # REST sends JSON, the floats are needed anyway
+    return [
+        models.SearchRequest(
+            vector=vector,
+            limit=query.limit,
+            filter=query.filter if filters is None else filters[i],
+            params=query.params,
+            with_payload=query.with_payload,
+        )
+        for i, vector in enumerate(vectors.tolist())
+    ]
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop thread all async Qdrant calls of the process run on"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='qdrant-io', daemon=True).start()
+    return _loop
+
+
+@dataclass(frozen=True)
+class QdrantEndpoint:
+    """
+    Qdrant instance given by request credentials. Clients are pooled per
+    endpoint for the life of the process, so requests reuse connections.
+    `host` is passed as the client location, `:memory:` gives an
+    in-process instance
+    """
+    host: str
+    api_key: str
+    port: int
+
+    @property
+    def in_memory(self) -> bool:
+        return self.host == ':memory:'
+
+    def client(self) -> QdrantClient:
+        with _lock:
+            if self not in _clients:
+                _clients[self] = QdrantClient(self.host, **({} if self.in_memory else _options(self)))
+            return _clients[self]
+
+    def async_client(self) -> AsyncQdrantClient:
+        """Must be called on the loop of `_event_loop`"""
+        if self not in _async_clients:
+            _async_clients[self] = AsyncQdrantClient(self.host, **_options(self))
+        return _async_clients[self]
+
+    @property
+    def grpc(self) -> bool:
+        """Whether requests go over gRPC, where vectors are sent without converting them to lists"""
+        return QDRANT_PREFER_GRPC and not self.in_memory
+
+    def search_batch(
+        self,
+        collection: str,
+        vectors: np.ndarray,
+        query: Query,
+        filters: list[models.Filter | None] | None = None,
+    ) -> list[list[models.ScoredPoint]]:
+        """
+        Searches every vector, with a filter per vector if `filters` are
+        given. Long batches are sent as concurrent sub-requests
+        """
+        # an async in-memory client would be a separate instance
+        if self.in_memory:
+            return self.client().search_batch(collection, _rest_queries(vectors, query, filters))
+        future = asyncio.run_coroutine_threadsafe(self._search_chunks(collection, vectors, query, filters), _event_loop())
+        return future.result()
+
+    async def _search_chunks(
+        self,
+        collection: str,
+        vectors: np.ndarray,
+        query: Query,
+        filters: list[models.Filter | None] | None,
+    ) -> list[list[models.ScoredPoint]]:
+        client = self.async_client()
+        semaphore = asyncio.Semaphore(QDRANT_SEARCH_CONCURRENCY)
+
+        async def search(chunk, chunk_filters):
+            async with semaphore:
+                if not self.grpc:
+                    return await client.search_batch(collection, _rest_queries(chunk, query, chunk_filters))
+                response = await client.grpc_points.SearchBatch(
+                    grpc.SearchBatchPoints(
+                        collection_name=collection,
+                        search_points=_grpc_queries(grpc.SearchPoints, chunk, query, chunk_filters, collection_name=collection),
+                    ),
+                    timeout=QDRANT_TIMEOUT,
+                )
+                return [[GrpcToRest.convert_scored_point(point) for point in result.result] for result in response.result]
+
+        results = await asyncio.gather(*[
+            search(vectors[i:i + QDRANT_SEARCH_CHUNK], None if filters is None else filters[i:i + QDRANT_SEARCH_CHUNK])
+            for i in range(0, len(vectors), QDRANT_SEARCH_CHUNK)
+        ])
+        return [result for chunk in results for result in chunk]
+
+    def search_groups(
+        self,
+        collection: str,
+        vectors: np.ndarray,
+        query: Query,
+        group_by: str,
+        group_size: int = 1,
+    ) -> list[list[models.ScoredPoint]]:
+        """
+        Grouped counterpart of `search_batch`: for every vector the hits of
+        its best `limit` groups of `group_by`, `group_size` hits per group,
+        best group first. Qdrant has no batch endpoint for grouped search,
+        so the queries are sent concurrently
+        """
+        if self.in_memory:
+            client = self.client()
+            return [
+                _group_hits(client.search_groups(collection, group_by=group_by, group_size=group_size, **_group_query(request)))
+                for request in _rest_queries(vectors, query)
+            ]
+        future = asyncio.run_coroutine_threadsafe(
+            self._search_groups(collection, vectors, query, group_by, group_size),
+            _event_loop()
+        )
+        return future.result()
+
+    async def _search_groups(
+        self,
+        collection: str,
+        vectors: np.ndarray,
+        query: Query,
+        group_by: str,
+        group_size: int,
+    ) -> list[list[models.ScoredPoint]]:
+        client = self.async_client()
+        semaphore = asyncio.Semaphore(QDRANT_GROUP_CONCURRENCY)
+
+        async def search(request):
+            async with semaphore:
+                if not self.grpc:
+                    return _group_hits(await client.search_groups(
+                        collection, group_by=group_by, group_size=group_size, **_group_query(request)
+                    ))
+                response = await client.grpc_points.SearchGroups(request, timeout=QDRANT_TIMEOUT)
+                return [GrpcToRest.convert_scored_point(hit) for group in response.result.groups for hit in group.hits]
+
+        if self.grpc:
+            requests = _grpc_queries(
+                grpc.SearchPointGroups, vectors, query,
+                collection_name=collection, group_by=group_by, group_size=group_size,
+            )
+        else:
+            requests = _rest_queries(vectors, query)
+        return list(await asyncio.gather(*[search(request) for request in requests]))
+
+    def upsert(self, collection: str, ids: list[str], vectors: np.ndarray, payloads: list[dict], wait: bool = True) -> Future:
+        """
+        Sends an upsert without blocking the caller, the future resolves once
+        Qdrant accepted the points, or with `wait` once it applied them
+        """
+        if self.in_memory:
+            future = Future()
+            try:
+                batch = models.Batch(ids=ids, vectors=vectors.tolist(), payloads=payloads)
+                future.set_result(self.client().upsert(collection, points=batch, wait=wait))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return asyncio.run_coroutine_threadsafe(self._upsert(collection, ids, vectors, payloads, wait), _event_loop())
+
+    async def _upsert(self, collection: str, ids: list[str], vectors: np.ndarray, payloads: list[dict], wait: bool) -> models.UpdateResult:
+        client = self.async_client()
+        if not self.grpc:
+            batch = models.Batch(ids=ids, vectors=vectors.tolist(), payloads=payloads)
+            return await client.upsert(collection, points=batch, wait=wait)
+        points = []
+        for point_id, vector, payload in zip(ids, vectors, payloads):
+            point = grpc.PointStruct(id=RestToGrpc.convert_extended_point_id(point_id), payload=RestToGrpc.convert_payload(payload))
+            point.vectors.vector.MergeFromString(_packed_floats(grpc.Vector.DESCRIPTOR.fields_by_name['data'].number, vector))
+            points.append(point)
+        response = await client.grpc_points.Upsert(
+            grpc.UpsertPoints(collection_name=collection, wait=wait, points=points),
+            timeout=QDRANT_TIMEOUT,
+        )
+        return GrpcToRest.convert_update_result(response.result)
+
+
+def _group_query(request: models.SearchRequest) -> dict:
+    return dict(
+        query_vector=request.vector,
+        limit=request.limit,
+        query_filter=request.filter,
+        search_params=request.params,
+        with_payload=request.with_payload,
+    )
+
+
+def _group_hits(result: models.GroupsResult) -> list[models.ScoredPoint]:
+    return [hit for group in result.groups for hit in group.hits]
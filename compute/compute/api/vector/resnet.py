@@ -1,10 +1,12 @@
 from typing import Iterable
 import warnings
+import numpy as np
 import torch
 
 from PIL import Image
 
 from .base import BaseImageEmbedder
+from .preprocess import BatchImagePreprocessor
 from transformers import AutoModel, AutoProcessor
 
 class ResNetImageEmbedder(BaseImageEmbedder):
@@ -16,35 +18,23 @@ class ResNetImageEmbedder(BaseImageEmbedder):
         self.device = device
         self.processor = AutoProcessor.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name).to(device)
+        self.preprocess = BatchImagePreprocessor.from_processor(self.processor)
         
         
     
-    def vectorize(self, *images: Image.Image, batch_size: int) -> Iterable[list[float]]:                    
-        with torch.no_grad():
-            current_batch = []
-            for image in images:
-                inputs = self.processor(images=image, return_tensors='pt')
-                current_batch.append(inputs)
-                if len(current_batch) == batch_size:
-                    batch_inputs = {
-                        key: torch.cat([value[key] for value in current_batch], dim=0).to(self.device)
-                        for key in current_batch[0].keys()
-                    }
-                    outputs = self.model(**batch_inputs)
-                    embeddings = outputs.pooler_output.flatten(1).cpu().tolist()
-                    for embedding in embeddings:
-                        yield embedding
-                    current_batch = []
+    def _pixel_values(self, images: list[Image.Image]) -> torch.Tensor:
+        if self.preprocess is not None:
+            return self.preprocess(images, device=self.device)
+        # fast processors batch themselves, their output differs from `BatchImagePreprocessor`
+        return self.processor(images=list(images), return_tensors='pt')['pixel_values'].to(self.device)
 
-            if current_batch:
-                batch_inputs = {
-                    key: torch.cat([value[key] for value in current_batch], dim=0).to(self.device)
-                    for key in current_batch[0].keys()
-                }
-                outputs = self.model(**batch_inputs)
-                embeddings = outputs.pooler_output.flatten(1).cpu().tolist()
-                for embedding in embeddings:
-                    yield embedding
+    def vectorize_array(self, *images: Image.Image, batch_size: int, dtype: np.dtype = np.float32) -> Iterable[np.ndarray]:
+        with torch.no_grad():
+            for i in range(0, len(images), batch_size):
+                pixel_values = self._pixel_values(images[i:i + batch_size])
+                outputs = self.model(pixel_values=pixel_values)
+                embeddings = outputs.pooler_output.flatten(1).float().cpu().numpy()
+                yield np.ascontiguousarray(embeddings, dtype=dtype)
                     
 if __name__ == '__main__':
     embedder = ResNetImageEmbedder('microsoft/resnet-50')
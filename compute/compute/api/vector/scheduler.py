@@ -0,0 +1,127 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+from .base import BaseImageEmbedder
+from .metrics import INFERENCE_BATCH_SIZE, INFERENCE_SECONDS, PREPROCESS_SECONDS
+from .patches import BOX
+
+INFER_MAX_BATCH = int(os.getenv('INFER_MAX_BATCH', 32))
+INFER_MAX_DELAY_MS = float(os.getenv('INFER_MAX_DELAY_MS', 10))
+
+logger = logging.getLogger('uvicorn')
+
+
+class _Chunk:
+    def __init__(self, images: list[Image.Image], boxes: tuple[BOX, ...] | None):
+        self.images = images
+        self.boxes = boxes
+        self.future: Future = Future()
+
+
+class InferenceScheduler:
+    """
+    Single in-process inference loop shared by all requests.
+
+    Requests submit images and wait on futures; the loop thread packs
+    images of all in-flight requests into batches of at most `max_batch`
+    images, waiting up to `max_delay` seconds for a batch to fill up,
+    and routes the embeddings back. Only one batch is in the model at a
+    time, which puts a fixed ceiling on inference memory.
+    """
+    def __init__(self, emb: BaseImageEmbedder, max_batch: int = INFER_MAX_BATCH, max_delay: float = INFER_MAX_DELAY_MS / 1000):
+        self.emb = emb
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.images = 0
+
+        self._queue: queue.Queue[_Chunk] = queue.Queue()
+        self._pending: deque[_Chunk] = deque()
+        self._thread = threading.Thread(target=self._loop, name='inference-scheduler', daemon=True)
+        self._thread.start()
+
+    @property
+    def input_side(self) -> int:
+        return self.emb.input_side
+
+    def submit(self, *images: Image.Image, boxes: list[BOX] | None = None) -> list[Future]:
+        boxes = tuple(boxes) if boxes is not None else None
+        chunks = [
+            _Chunk(list(images[i:i + self.max_batch]), boxes)
+            for i in range(0, len(images), self.max_batch)
+        ]
+        for chunk in chunks:
+            self._queue.put(chunk)
+        return [chunk.future for chunk in chunks]
+
+    def embed(self, *images: Image.Image, boxes: list[BOX] | None = None) -> np.ndarray:
+        """
+        `(n, dim)` CLS embeddings, or `(n, len(boxes) + 1, dim)` region
+        descriptors when `boxes` are given
+        """
+        futures = self.submit(*images, boxes=boxes)
+        return np.concatenate([future.result() for future in futures])
+
+    def _next(self, timeout: float | None) -> _Chunk | None:
+        if self._pending:
+            return self._pending.popleft()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect(self) -> list[_Chunk]:
+        first = self._next(None)
+        batch, size = [first], len(first.images)
+        deferred = []
+        deadline = time.perf_counter() + self.max_delay
+        while size < self.max_batch:
+            chunk = self._next(max(0., deadline - time.perf_counter()))
+            if chunk is None:
+                break
+            if chunk.boxes != first.boxes or size + len(chunk.images) > self.max_batch:
+                deferred.append(chunk)
+                if chunk.boxes == first.boxes:
+                    break
+                continue
+            batch.append(chunk)
+            size += len(chunk.images)
+        self._pending.extendleft(reversed(deferred))
+        return batch
+
+    def _run(self, batch: list[_Chunk]):
+        images = [image for chunk in batch for image in chunk.images]
+        boxes = batch[0].boxes
+        preprocess_s, inference_s = self.emb.preprocess_s, self.emb.inference_s
+        if boxes is None:
+            embeddings = self.emb.embed(*images, batch_size=len(images))
+        else:
+            embeddings = np.concatenate([*self.emb.vectorize_regions(*images, boxes=list(boxes), batch_size=len(images))])
+        INFERENCE_BATCH_SIZE.observe(len(images))
+        PREPROCESS_SECONDS.observe(self.emb.preprocess_s - preprocess_s)
+        INFERENCE_SECONDS.observe(self.emb.inference_s - inference_s)
+
+        offset = 0
+        for chunk in batch:
+            chunk.future.set_result(embeddings[offset:offset + len(chunk.images)])
+            offset += len(chunk.images)
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._run(batch)
+                self.batches += 1
+                self.images += sum(len(chunk.images) for chunk in batch)
+            except Exception as e:
+                logger.exception('Inference batch failed')
+                for chunk in batch:
+                    chunk.future.set_exception(e)
@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+
+# Collection of temporally pooled frame embeddings, the coarse stage of moderation
+SEGMENT_COLLECTION = 'dev__segments'
+SEGMENT_SECONDS = float(os.getenv('SEGMENT_SECONDS', 10))
+# `mean` of the frame embeddings, or `gem`: a signed generalized mean that
+# weights the dominant components of the frames higher
+SEGMENT_POOLING = os.getenv('SEGMENT_POOLING', 'mean')
+SEGMENT_GEM_P = float(os.getenv('SEGMENT_GEM_P', 3))
+
+
+def pool_segments(
+    seconds: np.ndarray,
+    vectors: np.ndarray,
+    window: float = SEGMENT_SECONDS,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pools frame embeddings over consecutive `window`-second segments.
+    Returns the segment start seconds, the index of the first frame and
+    the number of frames of every segment and the unit-normalized pooled
+    embeddings, segments without frames are left out
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    buckets, first, inverse, counts = np.unique(
+        np.floor(np.asarray(seconds, dtype=np.float64) / window).astype(np.int64),
+        return_index=True,
+        return_inverse=True,
+        return_counts=True,
+    )
+    if SEGMENT_POOLING == 'gem':
+        vectors = np.sign(vectors) * np.abs(vectors) ** SEGMENT_GEM_P
+    elif SEGMENT_POOLING != 'mean':
+        raise ValueError(f'Unknown segment pooling: {SEGMENT_POOLING}')
+
+    pooled = np.zeros((len(buckets), vectors.shape[1]), dtype=np.float32)
+    np.add.at(pooled, inverse, vectors)
+    pooled /= counts[:, None]
+    if SEGMENT_POOLING == 'gem':
+        pooled = np.sign(pooled) * np.abs(pooled) ** (1 / SEGMENT_GEM_P)
+    pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+    return buckets * window, first, counts, pooled
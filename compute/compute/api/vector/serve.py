@@ -0,0 +1,176 @@
+"""
+Pre-fork launcher of the compute server.
+
+    python -m vector.serve --host 0.0.0.0 --port 8000 --workers 4 --pin
+
+With the torch backend on CPU the embedder is loaded once in the parent
+process and the workers are forked from it, so the weights are shared
+copy-on-write instead of being loaded by every worker. The physical
+cores available to the process are split between the workers: each one
+runs torch with one intra-op thread per physical core it got and, with
+`--pin`, is pinned to those cores.
+"""
+import argparse
+import gc
+import logging
+import logging.config
+import os
+import signal
+import sys
+import tempfile
+import time
+
+# Keeps `torch.cuda.is_available()` from initializing the driver in the parent
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+COMPUTE_WORKERS = int(os.getenv('COMPUTE_WORKERS', 1))
+# Intra-op threads per worker, `0` uses the physical cores of the worker
+COMPUTE_THREADS = int(os.getenv('COMPUTE_THREADS', 0))
+COMPUTE_PIN_CORES = os.getenv('COMPUTE_PIN_CORES', '0') == '1'
+
+logger = logging.getLogger('uvicorn')
+
+
+def physical_cores() -> list[list[int]]:
+    """Logical CPUs available to the process, grouped by physical core"""
+    cores: dict[tuple[int, int], list[int]] = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        topology = f'/sys/devices/system/cpu/cpu{cpu}/topology'
+        try:
+            with open(f'{topology}/physical_package_id') as f:
+                package = int(f.read())
+            with open(f'{topology}/core_id') as f:
+                core = int(f.read())
+        except (OSError, ValueError):
+            package, core = -1, cpu
+        cores.setdefault((package, core), []).append(cpu)
+    return list(cores.values())
+
+
+def partition(cores: list[list[int]], workers: int) -> list[list[list[int]]]:
+    """Splits physical cores into `workers` contiguous groups of (almost) equal size"""
+    if workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    share, extra = divmod(len(cores), workers)
+    groups, start = [], 0
+    for i in range(workers):
+        end = start + share + (i < extra)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _configure_threads(cores: list[list[int]], threads: int, pin: bool):
+    import torch
+
+    if pin:
+        os.sched_setaffinity(0, [cpu for core in cores for cpu in core])
+    torch.set_num_threads(threads)
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+
+
+def _serve(config, sockets, cores: list[list[int]], threads: int, pin: bool):
+    import uvicorn
+
+    _configure_threads(cores, threads, pin)
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=COMPUTE_WORKERS)
+    parser.add_argument('--threads', type=int, default=COMPUTE_THREADS)
+    parser.add_argument('--pin', action='store_true', default=COMPUTE_PIN_CORES)
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+
+    groups = partition(physical_cores(), args.workers)
+    threads = [args.threads or len(group) for group in groups]
+    # FFmpeg decoders of a worker get the same share of cores as torch
+    os.environ.setdefault('FRAME_DECODE_THREADS', str(min(threads)))
+    if args.workers > 1 and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        # `/metrics` of any worker reports the metrics of all of them
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='compute-metrics-')
+
+    import torch
+    import uvicorn
+    from prometheus_client import multiprocess
+    from .backends import VBACKEND
+    from . import server
+
+    config = uvicorn.Config(server.compute, host=args.host, port=args.port, log_level=args.log_level)
+    logging.config.dictConfig(uvicorn.config.LOGGING_CONFIG)
+    logger.info(f'{args.workers} worker(s), intra-op threads {threads}, cores {groups}, pinned: {args.pin}')
+
+    if args.workers == 1:
+        _serve(config, None, groups[0], threads[0], args.pin)
+        return
+
+    if torch.cuda.is_available():
+        raise SystemExit('Forked workers are CPU only, run one worker per GPU instead')
+
+    # ONNX Runtime sessions own thread pools that do not survive a fork,
+    # with the ONNX backends every worker creates its own session
+    if VBACKEND == 'torch':
+        # no intra-op thread pool may exist in the parent, it would not survive the fork either
+        torch.set_num_threads(1)
+        server.runtime.preload()
+        logger.info(f'Embedder loaded before fork: {server.runtime.timings}')
+    # keeps the collector from dirtying shared pages of the preloaded objects
+    gc.freeze()
+
+    sockets = [config.bind_socket()]
+    children: dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                _serve(config, sockets, groups[index], threads[index], args.pin)
+            except BaseException:
+                logger.exception(f'Worker {index} failed')
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(args.workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        multiprocess.mark_process_dead(pid)
+        if index is not None and not stopping:
+            logger.warning(f'Worker {index} (pid {pid}) exited with status {status}, restarting')
+            time.sleep(1)
+            spawn(index)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
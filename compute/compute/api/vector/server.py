@@ -1,130 +1,214 @@
-import tempfile
-import uuid
-import cv2
+import logging
+import resource
+import threading
+import time
 import os
+from contextlib import asynccontextmanager
+import numpy as np
 import pandas as pd
-from qdrant_client import QdrantClient, models
-import requests
-from .vit import VitImageEmbedder
 from PIL import Image
-import torch
-from fastapi import FastAPI
+from qdrant_client import models
+from .base import BaseImageEmbedder
+from .backends import VBACKEND, VQUANT, load_embedder
+from .scheduler import InferenceScheduler
+from .frames import (
+    FRAME_DECODER,
+    FRAME_GATE_DISTANCE,
+    FRAME_MIN_EDGE_DENSITY,
+    FRAME_MIN_ENTROPY,
+    FRAME_MIN_STD,
+    FrameSource,
+    make_frame_source,
+)
+from .pipeline import Pipeline
+from .qdrant_pool import QdrantEndpoint
+from .store import Hit, PointWriter, VectorStore, get_store, point_id
+from . import metrics
+from .download import FetchedVideo, fetch_video
+from .cache import CachedEmbeddings, cache
+from .align import align_offsets
+from .matrices import matrices
+from .segments import SEGMENT_COLLECTION, SEGMENT_SECONDS, pool_segments
+from .patches import BOX, get_grid_boxes, get_patches, get_overlay_patches  # noqa: F401
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 
-BOX = tuple[float, float, float, float]
 MODEL = os.getenv('VMODEL', 'facebook/dinov2-large')
+# Local directory with the weights of `MODEL` saved by `python -m vector.backends`,
+# loaded from memory-mapped safetensors without HF hub lookups
+MODEL_PATH = os.getenv('VMODEL_PATH')
+# Runs one full batch through the model before the server reports ready
+VWARMUP = os.getenv('VWARMUP', '1') == '1'
 VIOLATION_IMAGE_SIMILARITY_THRESHOLD = 0.88
+# Shorter side frames are decoded at: `0` keeps the original resolution,
+# `auto` decodes at the resolution the embedder needs for the patch grid
+FRAME_SHORT_SIDE = os.getenv('FRAME_SHORT_SIDE', '0')
+# `crop` embeds every patch crop separately, `pool` pools the patch regions
+# from the patch tokens of a single forward pass over the full, uncropped frame.
+# `/index` stores the CLS embedding of the same uncropped frame in `pool` mode,
+# so switching modes needs the catalog indexed again, as switching models does
+PATCH_MODE = os.getenv('PATCH_MODE', 'crop')
+# `grid_size:cpr` regions pooled in `pool` mode, e.g. `2:1,3:1,2:0.5`
+PATCH_REGIONS = [
+    (int(grid_size), float(cpr))
+    for grid_size, cpr in (region.split(':') for region in os.getenv('PATCH_REGIONS', '2:1').split(','))
+]
+# With exact verification only every n-th sampled frame is searched, to nominate the source videos,
+# the rest are searched again among the matching videos that could not be verified
+VERIFY_NOMINATE_EVERY = int(os.getenv('VERIFY_NOMINATE_EVERY', 4))
+# Source videos shortlisted by a search of the probe segments before the frame search,
+# `0` searches the frames against the whole catalog. Needs every indexed video to have
+# its segments (`python -m api.qdrant segments` backfills them)
+SEGMENT_SHORTLIST = int(os.getenv('SEGMENT_SHORTLIST', 0))
+# `/index` pools the segments of the video into `SEGMENT_COLLECTION`, which has to
+# exist on the endpoint. On by default when moderation shortlists
+SEGMENT_INDEX = os.getenv('SEGMENT_INDEX', '1' if SEGMENT_SHORTLIST else '0') == '1'
+# Version of what an embedding cache entry holds, bumped when its metadata
+# or the embeddings of a patch mode change
+EMBEDDING_CACHE_FORMAT = 2
 
-vit = VitImageEmbedder(
-    MODEL,
-    device=('cuda' if torch.cuda.is_available() else 'cpu')
-)
+def _short_side(emb: BaseImageEmbedder | InferenceScheduler, grid_size: int = 1) -> int:
+    if FRAME_SHORT_SIDE == 'auto':
+        return emb.input_side * grid_size
+    return int(FRAME_SHORT_SIDE)
+
+
+logger = logging.getLogger('uvicorn')
 
-compute = FastAPI()
 
-def naive_clusters(labels, max_width=100) -> list[tuple]:
+class _Runtime:
     """
-    Naively iterates over the 1D array yielding groups
-    of elements where gap between each element is less than max_width
+    Embedder and inference scheduler of the server.
+
+    The model is loaded in a background thread once the server starts,
+    so the process accepts connections right away and `/ready` reports
+    when requests can be served. Endpoints block in `get` until then
     """
-    clusters = []
-    current_cluster = []
-    for i, label in enumerate(labels):
-        if len(current_cluster) == 0:
-            current_cluster.append(label)
-        elif label - current_cluster[-1] <= max_width:
-            current_cluster.append(label)
-        else:
-            clusters.append(current_cluster)
-            current_cluster = [label]
-    clusters.append(current_cluster)
-    
-    spans = [(cluster[0], cluster[-1]) for cluster in clusters]
-    return spans
-
-
-def has_violations(df: pd.DataFrame, thresh = VIOLATION_IMAGE_SIMILARITY_THRESHOLD) -> bool:
-    """Checks on any violations"""
-    return (df.score > thresh).any()
-
-def get_violations(df: pd.DataFrame, thresh = VIOLATION_IMAGE_SIMILARITY_THRESHOLD) -> pd.DataFrame:
-    """"""
-    df = df[df.score > thresh]
-    f_ = df.frame.unique()
-    f_.sort()
-    if f_.shape[0] < 2:
-        return []
-    frame_lag = f_[1] - f_[0]
-    spans = naive_clusters(f_, frame_lag * 50)
-    return [sp for sp in spans if sp[1] - sp[0] >= frame_lag * 10]
-
-
-def get_patches(image : Image.Image, grid_size: int) -> list[tuple[BOX, Image.Image]]:
-    width, height = image.size
-    patch_width = width // grid_size
-    patch_height = height // grid_size
-    
-    patches = []
-    for i in range(grid_size):
-        for j in range(grid_size):
-            left = i * patch_width
-            upper = j * patch_height
-            right = left + patch_width
-            lower = upper + patch_height
-            patch = image.crop((left, upper, right, lower))
-            patches.append(((left / width, upper / height, right / width, lower / height), patch))
-                        
-    return patches
-
-
-def get_overlay_patches(image: Image.Image, grid_size: int, cpr: float) -> list[tuple[BOX, Image.Image]]:
-    width, height = image.size
-    patch_width = width // grid_size
-    patch_height = height // grid_size
-    
-    patches = []
-    i, j = 0, 0
-    while i + patch_width * .5 <= width:
-        while j + patch_height * .5 <= height:
-            left = i
-            upper = j
-            right = left + patch_width 
-            lower = upper + patch_height
-            patch = image.crop((left, upper, right, lower))
-            patches.append(((left / width, upper / height, right / width, lower / height), patch))
-            j += int(patch_height * cpr)
-        i += int(patch_width * cpr)
-        j = 0
-        
-    return patches
+    def __init__(self):
+        self.loaded = threading.Event()
+        self.embedder: BaseImageEmbedder | None = None
+        self.scheduler: InferenceScheduler | None = None
+        self.error: str | None = None
+        self.timings: dict[str, float] = {}
 
+    def preload(self):
+        """Loads the embedder ahead of forking workers, which then share its weights"""
+        start = time.perf_counter()
+        self.embedder = load_embedder(MODEL_PATH or MODEL)
+        self.timings['load_s'] = round(time.perf_counter() - start, 3)
 
-def _process_one_video(path: str, emb: VitImageEmbedder, qdrant: QdrantClient, batch_size: int = 1000):
-    cap = cv2.VideoCapture(path)
-    df = []
+    def load(self):
+        try:
+            if self.embedder is None:
+                self.preload()
+            scheduler = InferenceScheduler(self.embedder)
+            if VWARMUP:
+                start = time.perf_counter()
+                _warmup(scheduler)
+                self.timings['warmup_s'] = round(time.perf_counter() - start, 3)
+            self.scheduler = scheduler
+            logger.info(f'Embedder {MODEL} is ready: {self.timings}')
+        except Exception as e:
+            logger.exception(f'Could not load embedder {MODEL}')
+            self.error = repr(e)
+        finally:
+            self.loaded.set()
+
+    def get(self) -> InferenceScheduler:
+        self.loaded.wait()
+        if self.scheduler is None:
+            raise HTTPException(status_code=503, detail=f'Embedder failed to load: {self.error}')
+        return self.scheduler
+
+
+def _warmup(scheduler: InferenceScheduler):
+    """Runs a full batch of frames at decode resolution through the model"""
+    side = _short_side(scheduler, 1 if PATCH_MODE == 'pool' else 2) or scheduler.input_side
+    images = [Image.new('RGB', (side * 16 // 9, side))] * scheduler.max_batch
+    if PATCH_MODE == 'pool':
+        scheduler.embed(*images, boxes=_region_labels()[1])
+    else:
+        scheduler.embed(*images)
+
+
+runtime = _Runtime()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=runtime.load, name='embedder-loader', daemon=True).start()
+    yield
 
-    frame_idx = 0
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+compute = FastAPI(lifespan=lifespan)
+
+
+@compute.middleware('http')
+async def track_requests(request: Request, call_next):
+    endpoint = request.url.path
+    if endpoint not in ('/moderate', '/index'):
+        return await call_next(request)
+    with metrics.REQUESTS_IN_FLIGHT.labels(endpoint).track_inprogress(), \
+            metrics.REQUEST_SECONDS.labels(endpoint).time():
+        return await call_next(request)
+
+
+@compute.get('/metrics')
+def get_metrics():
+    content, content_type = metrics.render()
+    return Response(content, media_type=content_type)
+
+
+@compute.get('/ready')
+def ready(response: Response):
+    if runtime.scheduler is None:
+        response.status_code = 503
+    return {
+        'ready': runtime.scheduler is not None,
+        'error': runtime.error,
+        **runtime.timings,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def _region_labels() -> tuple[list[tuple[int, int, float]], list[BOX]]:
+    """Point labels and boxes of the regions pooled in `pool` patch mode"""
+    labels, boxes = [], []
+    for grid_size, cpr in PATCH_REGIONS:
+        for i, box in enumerate(get_grid_boxes(grid_size, cpr)):
+            labels.append((i, grid_size, cpr))
+            boxes.append(box)
+    return labels, boxes
+
+
+def _frame_batches(source: FrameSource, batch_size: int, duplicates: list[tuple[int, int]]):
+    """
+    Yields `(images, point_data, frame_idxs)` batches of frames and their patches.
+    Frames the gate marked as repeats are not embedded, `(frame, repeated_frame)`
+    pairs are collected into `duplicates` instead
+    """
     batch_images = []
     batch_point_data = []
     batch_frames_idxs = []
-    
-    while True:
-        frame_idx += 1
-        
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        if frame_idx % fps != 0 and not frame_idx == total_frames:
+    region_labels, _ = _region_labels()
+
+    for sampled in source:
+        if sampled.duplicate_of is not None:
+            duplicates.append((sampled.index, sampled.duplicate_of))
+            continue
+
+        pil_image = sampled.image
+
+        if PATCH_MODE == 'pool':
+            batch_images.append(pil_image)
+            batch_point_data.extend(region_labels + [(-1, 1, 1)])
+            batch_frames_idxs.extend([sampled.index] * (len(region_labels) + 1))
+            if len(batch_images) > batch_size:
+                yield batch_images, batch_point_data, batch_frames_idxs
+                batch_images = []
+                batch_point_data = []
+                batch_frames_idxs = []
             continue
 
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(frame)
-        
-        
         patches_2 = [
             (i, 2, 1, x) for i, x in enumerate(get_patches(pil_image, 2))
         ]
@@ -159,164 +243,577 @@ def _process_one_video(path: str, emb: VitImageEmbedder, qdrant: QdrantClient, b
         
         batch_images.extend(images)
         batch_point_data.extend(patch_labels)
-        batch_frames_idxs.extend([frame_idx] * len(images))
+        batch_frames_idxs.extend([sampled.index] * len(images))
         
-        if len(batch_images) > batch_size or frame_idx == total_frames:
-            vectors = [*emb.vectorize(*batch_images, batch_size=batch_size)]
-            results = qdrant.search_batch('dev__experiment', [
-                models.SearchRequest(
-                    vector=vec,
-                    limit=5,
-                    with_payload=True,
-                ) for vec in vectors
-            ])
-            
-            for (patch_idx, grid_size, cpr), fid, r in zip(batch_point_data, batch_frames_idxs, results):
-                for res in r:
-                    df.append({
-                        'frame': fid,
-                        'patch': grid_size,
-                        'patch_cpr': cpr,
-                        'patch_idx': patch_idx,
-                        'score': res.score,
-                        'video_name': res.payload['video_name'],
-                        'video_second': res.payload['second']
-                    })
-                    
+        if len(batch_images) > batch_size:
+            yield batch_images, batch_point_data, batch_frames_idxs
             batch_images = []
             batch_point_data = []
             batch_frames_idxs = []
-                        
-    return pd.DataFrame(df)
 
+    if batch_images:
+        yield batch_images, batch_point_data, batch_frames_idxs
+
+
+def _cache_key(video: FetchedVideo, kind: str) -> str | None:
+    """Embedding cache key of a video, `None` when the cache can not be used"""
+    if cache is None or video.sha256 is None:
+        return None
+    return cache.key(
+        video.sha256,
+        format=EMBEDDING_CACHE_FORMAT,
+        kind=kind,
+        model=MODEL,
+        backend=VBACKEND,
+        quantize=VQUANT,
+        every=1.0,
+        patch_mode=PATCH_MODE,
+        patch_regions=PATCH_REGIONS if PATCH_MODE == 'pool' else None,
+        frame_short_side=FRAME_SHORT_SIDE,
+        frame_decoder=FRAME_DECODER,
+        frame_gate_distance=FRAME_GATE_DISTANCE,
+        frame_quality=(FRAME_MIN_STD, FRAME_MIN_ENTROPY, FRAME_MIN_EDGE_DENSITY),
+    )
+
+
+def _cached_batches(cached: CachedEmbeddings, batch_size: int):
+    """Yields `(point_data, frame_idxs, vectors)` batches of cached moderation embeddings"""
+    meta = cached.meta
+    for i in range(0, len(cached.vectors), batch_size):
+        point_data = list(zip(
+            meta['patch_idx'][i:i + batch_size].tolist(),
+            meta['grid_size'][i:i + batch_size].tolist(),
+            meta['cpr'][i:i + batch_size].tolist(),
+        ))
+        yield point_data, meta['frame'][i:i + batch_size].tolist(), np.asarray(cached.vectors[i:i + batch_size])
+
+
+def _process_one_video(
+    video: FetchedVideo,
+    emb: InferenceScheduler,
+    store: VectorStore,
+    batch_size: int = 1000,
+    limit: int = 5,
+    group_by: str | None = None,
+    group_size: int = 1,
+    video_names: list[str] | None = None,
+    exclude_video_names: list[str] | None = None,
+    verify_videos: int = 0,
+    nominate_every: int = 1,
+    segment_store: VectorStore | None = None,
+    shortlist: int = 0,
+    threshold: float = VIOLATION_IMAGE_SIMILARITY_THRESHOLD,
+) -> tuple[pd.DataFrame, dict[str, int | float]]:
+    """
+    Runs decode -> embed -> search as a pipeline, so decoding of the next
+    batch and searching of the previous one overlap with inference.
+    `batch_size` is the number of images decoded per pipeline batch, model
+    batches are formed by the inference scheduler.
+
+    Embeddings of a video seen before are read from the embedding cache,
+    skipping decode and inference altogether.
+
+    Every vector gets its `limit` best hits, or with `group_by` the best
+    `group_size` hits of its `limit` best groups, optionally restricted
+    to / keeping out a set of source videos.
+
+    With `shortlist` the whole video is embedded first and its segments
+    are searched in `segment_store`, the frames are then only searched
+    among the `shortlist` source videos they match best.
+
+    With `verify_videos` only every `nominate_every`-th frame is searched
+    and the hits of the best `verify_videos` source videos are replaced
+    by exact similarities of all vectors against their frame matrices.
+    The other frames are then searched among the source videos with hits
+    above `threshold` that were not verified, so no video is left with
+    the hits of every `nominate_every`-th frame only
+    """
+    key = _cache_key(video, 'moderate')
+    cached = cache.get(key) if key else None
+    embedded = []
+    duplicates = []
+    probe = []
+    ordinals: dict[int, int] = {}
+    searched = 0
+
+    def embed(batch):
+        images, point_data, frames_idxs = batch
+        if PATCH_MODE == 'pool':
+            regions = emb.embed(*images, boxes=boxes)
+            vectors = regions.reshape(-1, regions.shape[-1])
+        else:
+            vectors = emb.embed(*images)
+        if key:
+            embedded.append((point_data, frames_idxs, vectors))
+        return point_data, frames_idxs, vectors
+
+    def search(batch):
+        nonlocal searched
+        point_data, frames_idxs, vectors = batch
+        if verify_videos:
+            probe.append((point_data, frames_idxs, vectors.astype(np.float16)))
+        if nominate_every > 1:
+            keep = [ordinals.setdefault(fid, len(ordinals)) % nominate_every == 0 for fid in frames_idxs]
+            point_data = [label for label, kept in zip(point_data, keep) if kept]
+            frames_idxs = [fid for fid, kept in zip(frames_idxs, keep) if kept]
+            vectors = vectors[np.array(keep)]
+        searched += len(vectors)
+        if not len(vectors):
+            return []
+        operation = 'search_groups' if group_by else 'search'
+        with metrics.VECTOR_STORE_SECONDS.labels(store.name, operation).time():
+            results = store.search(vectors, limit, group_by, group_size, video_names, exclude_video_names)
+        return _hit_rows(point_data, frames_idxs, results)
+
+    source = None
+    if cached is not None:
+        duplicates = list(zip(cached.meta['dup_frame'].tolist(), cached.meta['dup_ref'].tolist()))
+        fps = float(cached.meta['fps'])
+        pipeline = Pipeline('cache', _cached_batches(cached, batch_size))
+    else:
+        # every 2x2 patch should still cover the embedder input
+        source = make_frame_source(video.path, short_side=_short_side(emb, 1 if PATCH_MODE == 'pool' else 2))
+        fps = source.fps
+        _, boxes = _region_labels()
+        pipeline = Pipeline('decode', _frame_batches(source, batch_size, duplicates)) \
+            .then('embed', embed)
+
+    stats = {'cache_hit': int(cached is not None)}
+    embed_stats = {}
+    if shortlist:
+        batches = list(pipeline)
+        embed_stats = pipeline.stats()
+        candidates, shortlist_stats = _shortlist(
+            batches, duplicates, fps, segment_store, shortlist, video_names, exclude_video_names
+        )
+        stats.update(shortlist_stats)
+        if candidates:
+            video_names = candidates
+        else:
+            logger.warning('No segments matched the probe, searching its frames against the whole catalog')
+        pipeline = Pipeline('embedded', batches).then('search', search)
+    else:
+        pipeline.then('search', search)
+
+    df = []
+    for rows in pipeline:
+        df.extend(rows)
+    df = pd.DataFrame(df)
+
+    stats['points_searched'] = searched
+    if verify_videos and not df.empty:
+        df, verified, verify_stats = _verify(df, probe, verify_videos)
+        stats.update(verify_stats)
+        unverified = sorted(set(df[df.score > threshold].video_name) - set(verified))
+        if nominate_every > 1 and unverified:
+            skipped = [
+                (point_data, frames_idxs, vectors, [ordinals[fid] % nominate_every != 0 for fid in frames_idxs])
+                for point_data, frames_idxs, vectors in probe
+            ]
+            point_data = [label for labels, _, _, keep in skipped for label, kept in zip(labels, keep) if kept]
+            frames_idxs = [fid for _, fids, _, keep in skipped for fid, kept in zip(fids, keep) if kept]
+            vectors = np.concatenate([vectors[np.array(keep, dtype=bool)] for _, _, vectors, keep in skipped])
+            start = time.perf_counter()
+            with metrics.VECTOR_STORE_SECONDS.labels(store.name, 'search_unverified').time():
+                results = store.search(vectors.astype(np.float32), limit, group_by, group_size, unverified) if len(vectors) else []
+            df = pd.concat([df, pd.DataFrame(_hit_rows(point_data, frames_idxs, results))], ignore_index=True)
+            stats['videos_unverified'] = len(unverified)
+            stats['points_searched_unverified'] = len(vectors)
+            stats['search_unverified_s'] = round(time.perf_counter() - start, 3)
+
+    if duplicates and not df.empty:
+        # repeated frames reuse the search results of the frame they repeat
+        repeats = pd.DataFrame(duplicates, columns=['repeat', 'frame'])
+        copies = df.merge(repeats, on='frame')
+        copies['frame'] = copies.pop('repeat')
+        df = pd.concat([df, copies], ignore_index=True)
+    if not df.empty:
+        df['second'] = df.frame / fps
+
+    if source is not None:
+        metrics.observe_frames(source.stats)
+        stats.update(source.stats.as_dict())
+    stats['frames_gated'] = len(duplicates)
+
+    if embedded:
+        point_data = [label for labels, _, _ in embedded for label in labels]
+        cache.put(
+            key,
+            np.concatenate([vectors for _, _, vectors in embedded]),
+            frame=np.array([fid for _, frames_idxs, _ in embedded for fid in frames_idxs]),
+            patch_idx=np.array([label[0] for label in point_data]),
+            grid_size=np.array([label[1] for label in point_data]),
+            cpr=np.array([label[2] for label in point_data], dtype=np.float32),
+            dup_frame=np.array([repeat for repeat, _ in duplicates], dtype=np.int64),
+            dup_ref=np.array([frame for _, frame in duplicates], dtype=np.int64),
+            fps=np.array(fps),
+        )
+
+    return df, {**stats, **embed_stats, **pipeline.stats()}
+
+
+def _shortlist(
+    batches: list,
+    duplicates: list[tuple[int, int]],
+    fps: float,
+    store: VectorStore,
+    shortlist: int,
+    video_names: list[str] | None,
+    exclude_video_names: list[str] | None,
+) -> tuple[list[str], dict[str, int | float]]:
+    """
+    Source videos whose segments best match the segments of the probe,
+    best first. The probe is pooled into segments by the seconds of its
+    frames, as `/index` pools the source videos, repeats included
+    """
+    start = time.perf_counter()
+    full_frames = {
+        fid: vector
+        for point_data, frames_idxs, vectors in batches
+        for (patch_idx, _, _), fid, vector in zip(point_data, frames_idxs, vectors)
+        if patch_idx == -1
+    }
+    for repeat, frame in duplicates:
+        if frame in full_frames:
+            full_frames[repeat] = full_frames[frame]
+    if not full_frames:
+        return [], {'segments': 0, 'videos_shortlisted': 0, 'shortlist_s': round(time.perf_counter() - start, 3)}
+    frames = sorted(full_frames)
+    _, _, _, segments = pool_segments(np.array(frames) / fps, np.stack([full_frames[fid] for fid in frames]), SEGMENT_SECONDS)
+
+    with metrics.VECTOR_STORE_SECONDS.labels(store.name, 'search_segments').time():
+        results = store.search(segments, shortlist, 'video_name', 1, video_names, exclude_video_names)
+    scores: dict[str, float] = {}
+    for hits in results:
+        for hit in hits:
+            name = hit.payload['video_name']
+            scores[name] = max(scores.get(name, -1.), hit.score)
+    candidates = sorted(scores, key=scores.get, reverse=True)[:shortlist]
+    return candidates, {
+        'segments': len(segments),
+        'videos_shortlisted': len(candidates),
+        'shortlist_s': round(time.perf_counter() - start, 3),
+    }
+
+
+def _hit_rows(point_data: list, frames_idxs: list[int], results: list[list[Hit]]) -> list[dict]:
+    rows = []
+    for (patch_idx, grid_size, cpr), fid, r in zip(point_data, frames_idxs, results):
+        for res in r:
+            rows.append({
+                'frame': fid,
+                'patch': grid_size,
+                'patch_cpr': cpr,
+                'patch_idx': patch_idx,
+                'score': res.score,
+                'video_name': res.payload['video_name'],
+                'video_second': res.payload['second']
+            })
+    return rows
+
+
+def _verify(df: pd.DataFrame, probe: list, videos: int) -> tuple[pd.DataFrame, list[str], dict[str, int | float]]:
+    """
+    Replaces the search hits of the best `videos` source videos with the
+    exact best match of every probe vector among their frames, one matrix
+    product per video. Videos indexed without a matrix keep their hits.
+    Returns the videos verified
+    """
+    start = time.perf_counter()
+    labels = np.array([label for point_data, _, _ in probe for label in point_data])
+    frames = np.array([fid for _, frames_idxs, _ in probe for fid in frames_idxs])
+    points = np.concatenate([vectors for _, _, vectors in probe])
+
+    verified = {}
+    for video_name in df.groupby('video_name').score.max().nlargest(videos).index:
+        matches = matrices.best_matches(points, video_name)
+        if matches is None:
+            continue
+        scores, seconds = matches
+        verified[video_name] = pd.DataFrame({
+            'frame': frames,
+            'patch': labels[:, 1].astype(int),
+            'patch_cpr': labels[:, 2],
+            'patch_idx': labels[:, 0].astype(int),
+            'score': scores,
+            'video_name': video_name,
+            'video_second': seconds,
+        })
+    if verified:
+        df = pd.concat([df[~df.video_name.isin(list(verified))], *verified.values()], ignore_index=True)
+
+    verify_s = time.perf_counter() - start
+    metrics.VERIFY_SECONDS.observe(verify_s)
+    return df, list(verified), {'videos_verified': len(verified), 'verify_s': round(verify_s, 3)}
+
+
+def _report_stats(response: Response, stats: dict[str, int | float]):
+    """Exposes per-request compute stats as `X-Compute-*` response headers"""
+    for key, value in stats.items():
+        response.headers['X-Compute-' + key.replace('_', '-').title()] = str(value)
+    logger.info(f'compute stats: {stats}')
 
 
 class ModerateBody(BaseModel):
     video_link: str
+    # Qdrant endpoint searched, unused with the local store (`VSTORE=local`)
     qdrant_host: str
     qdrant_api_key: str
     qdrant_port: int
     batch_size: int = 1000
     threshold: float = VIOLATION_IMAGE_SIMILARITY_THRESHOLD
+    # hits per frame and patch: source videos when grouping by video, points otherwise
+    limit: int = 5
+    group_by_video: bool = True
+    group_size: int = 1
+    # HNSW search breadth, `None` keeps the collection default
+    hnsw_ef: int | None = None
+    # quantized collections: candidates fetched per result before rescoring with the original vectors
+    oversampling: float | None = None
+    rescore: bool = True
+    # restricts the search to these source videos / leaves these out, served by the `video_name` payload index
+    video_names: list[str] | None = None
+    exclude_video_names: list[str] | None = None
+    # source videos the frame search is narrowed to by a search of the probe segments, `0` searches all
+    shortlist: int = SEGMENT_SHORTLIST
+    # source videos whose hits are replaced by exact similarities against their frame
+    # matrices (`VIDEO_MATRIX_DIR`), `0` keeps the search hits
+    verify_videos: int = 5
+    # with verification, search only every n-th sampled frame to nominate the source videos
+    nominate_every: int = VERIFY_NOMINATE_EVERY
+
+    def search_params(self) -> models.SearchParams | None:
+        if self.hnsw_ef is None and self.oversampling is None and self.rescore:
+            return None
+        return models.SearchParams(
+            hnsw_ef=self.hnsw_ef,
+            quantization=models.QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling),
+        )
 
 
 @compute.post('/moderate')
-def moderate(body: ModerateBody):
-    video = requests.get(body.video_link).content
-    
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
-        f.write(video)
-        f.seek(0)
-        qdrant = QdrantClient(
-            body.qdrant_host,
-            api_key=body.qdrant_api_key,
-            port=body.qdrant_port
+def moderate(body: ModerateBody, response: Response):
+    scheduler = runtime.get()
+    endpoint = QdrantEndpoint(body.qdrant_host, body.qdrant_api_key, body.qdrant_port)
+    store = get_store(endpoint, body.search_params())
+    verify = matrices is not None and body.verify_videos > 0
+    download_start = time.perf_counter()
+    with fetch_video(body.video_link) as video:
+        download_s = time.perf_counter() - download_start
+        df, stats = _process_one_video(
+            video,
+            scheduler,
+            store,
+            batch_size=body.batch_size,
+            limit=body.limit,
+            group_by=('video_name' if body.group_by_video else None),
+            group_size=body.group_size,
+            video_names=body.video_names,
+            exclude_video_names=body.exclude_video_names,
+            verify_videos=body.verify_videos if verify else 0,
+            nominate_every=body.nominate_every if verify else 1,
+            threshold=body.threshold,
+            segment_store=get_store(endpoint, collection=SEGMENT_COLLECTION) if body.shortlist else None,
+            shortlist=body.shortlist,
         )
-        df = _process_one_video(f.name, vit, qdrant, batch_size=body.batch_size)
         df.insert(0, 'video_id', 0)
-        
-    df = df.loc[df.groupby('frame').score.idxmax()]
-    violations = []      
-    for key, d in df.groupby('video_name'):
-        if has_violations(d, body.threshold):
-            for start, end in get_violations(d, body.threshold):
-                violations.append({
-                    'start': int(start),
-                    'end': int(end),
-                    'video_name': str(key),
-                    'max_score': float(d[(d.frame >= start) & (d.frame <= end)].score.max()),
-                    'min_score': float(d[(d.frame >= start) & (d.frame <= end)].score.min()),
-                    'avg_score': float(d[(d.frame >= start) & (d.frame <= end)].score.mean()),
-                    'std_score': float(d[(d.frame >= start) & (d.frame <= end)].score.std()),
-                })
 
+    stats['download_s'] = round(download_s, 3)
+    if df.empty:
+        _report_stats(response, stats)
+        return []
+
+    clustering_start = time.perf_counter()
+    violations = align_offsets(df, body.threshold)
+
+    clustering_s = time.perf_counter() - clustering_start
+    metrics.VIOLATIONS_SECONDS.observe(clustering_s)
+    stats['clustering_s'] = round(clustering_s, 3)
+    _report_stats(response, stats)
     return violations
 
 
+def _embedded_frames(source: FrameSource, emb: InferenceScheduler, batch_size: int):
+    """
+    Yields `(frame_idxs, seconds, vectors)` batches of embedded sampled frames,
+    frames the gate marked as repeats reuse the embedding of the repeated frame
+    """
+    batch_frames = []
+    batch_frames_idxs = []
+    batch_seconds = []
+    last_vector = None
+
+    def embed():
+        nonlocal last_vector
+        distinct = [fr.image for fr in batch_frames if fr.duplicate_of is None]
+        if not distinct:
+            embedded = iter(())
+        elif PATCH_MODE == 'pool':
+            # the uncropped frame, preprocessed as the regions moderation searches with
+            embedded = iter(emb.embed(*distinct, boxes=[])[:, -1])
+        else:
+            embedded = iter(emb.embed(*distinct))
+        vectors = []
+        for fr in batch_frames:
+            if fr.duplicate_of is None:
+                last_vector = next(embedded)
+            vectors.append(last_vector)
+        return np.stack(vectors)
+
+    for sampled in source:
+        batch_frames.append(sampled)
+        batch_frames_idxs.append(sampled.index)
+        batch_seconds.append(sampled.second)
+
+        if len(batch_frames) == batch_size:
+            yield batch_frames_idxs, batch_seconds, embed()
+            batch_frames = []
+            batch_frames_idxs = []
+            batch_seconds = []
+
+    if batch_frames:
+        yield batch_frames_idxs, batch_seconds, embed()
+
+
+def _cached_frames(cached: CachedEmbeddings, batch_size: int):
+    """Yields `(frame_idxs, seconds, vectors)` batches of cached index embeddings"""
+    for i in range(0, len(cached.vectors), batch_size):
+        yield (
+            cached.meta['frame'][i:i + batch_size].tolist(),
+            cached.meta['second'][i:i + batch_size].tolist(),
+            np.asarray(cached.vectors[i:i + batch_size]),
+        )
+
+
 class IndexBody(BaseModel):
     video_id: int
     video_name: str
     video_link: str
+    # Qdrant endpoint written to, unused with the local store (`VSTORE=local`)
     qdrant_host: str
     qdrant_api_key: str
     qdrant_port: int
-    
+    # deletes the points left from an earlier indexing of the video once the new ones are
+    # written, searches find the old or the new point of every frame throughout
+    replace: bool = False
+
 
 @compute.post('/index')
-def index_video(body: IndexBody):
-    video = requests.get(body.video_link).content
-    qdrant = QdrantClient(
-        body.qdrant_host,
-        api_key=body.qdrant_api_key,
-        port=body.qdrant_port
-    )
-    
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
-        f.write(video)
-        f.seek(0)
-        video = cv2.VideoCapture(f.name)
+def index_video(body: IndexBody, response: Response):
+    scheduler = runtime.get()
+    endpoint = QdrantEndpoint(body.qdrant_host, body.qdrant_api_key, body.qdrant_port)
+    store = get_store(endpoint)
+
+    download_start = time.perf_counter()
+    with fetch_video(body.video_link) as video:
+        download_s = time.perf_counter() - download_start
+        key = _cache_key(video, 'index')
+        cached = cache.get(key) if key else None
+        if cached is not None:
+            width, height = cached.meta['size'].tolist()
+            batches = _cached_frames(cached, 33)
+            stats = {'cache_hit': 1}
+        else:
+            source = make_frame_source(video.path, short_side=_short_side(scheduler))
+            width, height = source.width, source.height
+            batches = _embedded_frames(source, scheduler, 33)
+
         df = []
-        frame_id = 0
-        fps = video.get(cv2.CAP_PROP_FPS)
-        
-        frame_id = 0
-        frame_number = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-        
-        each = int(fps)
-
-        batch_frames = []
-        batch_frames_idxs = []
-                
-        while True:
-            ret, frame = video.read()
-            if not ret:
-                break
-            
-            if frame_id % each == 0:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frame = Image.fromarray(frame)
-                batch_frames.append(frame)
-                batch_frames_idxs.append(frame_id)
-
-            if len(batch_frames) > 32 or frame_id == frame_number - 1:
-                points: list[models.PointStruct] = []
-                for i, fr, vector in zip(batch_frames_idxs, batch_frames, vit.vectorize(*batch_frames, batch_size=8)):
-                    points.append(
-                        models.PointStruct(
-                            id=uuid.uuid4().hex,
-                            vector=vector,
-                            payload={
-                                "video_id": body.video_id,
-                                "frame": i,
-                                "second": i / fps,
-                                "width": fr.width,
-                                "height": fr.height,
-                                "video_name": body.video_name,
-                            }
-                        )
-                    )
-            
-                qdrant.upsert("dev__experiment", points=points)
-                for point in points:
-                    df.append({
-                            "frame": int(point.payload["frame"]),
-                            "second": float(point.payload["second"]),
-                            "video_id": int(body.video_id),
-                            "qdrant_point_id": str(point.id),
-                            "width": int(point.payload["width"]),
-                            "height": int(point.payload["height"])
-                        }
-                    )
-
-                del batch_frames
-                del batch_frames_idxs
-                batch_frames = []
-                batch_frames_idxs = []
-                
-            frame_id += 1
-    
+        embedded = []
+        writer = PointWriter(store)
+        for frames_idxs, seconds, vectors in batches:
+            ids = [point_id(body.video_name, i) for i in frames_idxs]
+            payloads = [
+                {
+                    "video_id": body.video_id,
+                    "frame": i,
+                    "second": second,
+                    "width": width,
+                    "height": height,
+                    "video_name": body.video_name,
+                }
+                for i, second in zip(frames_idxs, seconds)
+            ]
+
+            writer.add(ids, vectors, payloads)
+            for pid, payload in zip(ids, payloads):
+                df.append({
+                        "frame": int(payload["frame"]),
+                        "second": float(payload["second"]),
+                        "video_id": int(body.video_id),
+                        "qdrant_point_id": pid,
+                        "width": int(payload["width"]),
+                        "height": int(payload["height"])
+                    }
+                )
+            embedded.append((frames_idxs, seconds, vectors))
+
+        writer.close()
+        metrics.VECTOR_STORE_SECONDS.labels(store.name, 'upsert').observe(writer.wait_s)
+        if body.replace:
+            with metrics.VECTOR_STORE_SECONDS.labels(store.name, 'replace').time():
+                store.delete_video(body.video_name, keep_ids=[row['qdrant_point_id'] for row in df])
+
+        if cached is None:
+            metrics.observe_frames(source.stats)
+            stats = {'cache_hit': 0, **source.stats.as_dict()}
+        stats['download_s'] = round(download_s, 3)
+        stats['upsert_s'] = round(writer.wait_s, 3)
+        stats['upsert_batches'] = writer.batches
+        if embedded:
+            vectors = np.concatenate([vectors for _, _, vectors in embedded])
+            frames = np.array([i for frames_idxs, _, _ in embedded for i in frames_idxs])
+            seconds = np.array([sec for _, seconds, _ in embedded for sec in seconds])
+            if key and cached is None:
+                cache.put(key, vectors, frame=frames, second=seconds, size=np.array([width, height]))
+            if matrices is not None:
+                matrices.put(body.video_name, vectors, frames, seconds)
+
+        if embedded and SEGMENT_INDEX:
+            segment_store = get_store(endpoint, collection=SEGMENT_COLLECTION)
+            starts, first, counts, segments = pool_segments(seconds, vectors)
+            segment_ids = [point_id(body.video_name, int(frames[i])) for i in first]
+            upsert_start = time.perf_counter()
+            segment_store.upsert(
+                segment_ids,
+                segments,
+                [
+                    {
+                        "video_id": body.video_id,
+                        "video_name": body.video_name,
+                        "frame": int(frames[i]),
+                        "second": float(start),
+                        "frames": int(count),
+                    }
+                    for start, i, count in zip(starts, first, counts)
+                ],
+            )
+            upsert_segments_s = time.perf_counter() - upsert_start
+            metrics.VECTOR_STORE_SECONDS.labels(segment_store.name, 'upsert_segments').observe(upsert_segments_s)
+            stats['segments'] = len(segments)
+            stats['upsert_segments_s'] = round(upsert_segments_s, 3)
+            if body.replace:
+                segment_store.delete_video(body.video_name, keep_ids=segment_ids)
+
+    _report_stats(response, stats)
     return pd.DataFrame(df).to_dict(orient='records')
 
-        
-    
-    
\ No newline at end of file
+
+class DeleteBody(BaseModel):
+    video_name: str
+    # Qdrant endpoint the points are deleted from, unused with the local store (`VSTORE=local`)
+    qdrant_host: str
+    qdrant_api_key: str
+    qdrant_port: int
+
+
+@compute.post('/delete')
+def delete_video(body: DeleteBody):
+    """Deletes the frame and segment points of a video and its frame matrix"""
+    endpoint = QdrantEndpoint(body.qdrant_host, body.qdrant_api_key, body.qdrant_port)
+    for store in (get_store(endpoint), get_store(endpoint, collection=SEGMENT_COLLECTION)):
+        with metrics.VECTOR_STORE_SECONDS.labels(store.name, 'delete').time():
+            store.delete_video(body.video_name)
+    if matrices is not None:
+        matrices.delete(body.video_name)
+    return True
@@ -0,0 +1,283 @@
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import Callable, Hashable
+from dataclasses import dataclass, replace
+
+import numpy as np
+from qdrant_client import models
+
+from .qdrant_pool import QdrantEndpoint, Query
+
+# `qdrant` searches the Qdrant instance given in the request,
+# `local` an in-process index in `VSTORE_PATH` (see `local_store.py`)
+VSTORE = os.getenv('VSTORE', 'qdrant')
+VSTORE_PATH = os.getenv('VSTORE_PATH', os.path.expanduser('~/.cache/copyright/store'))
+COLLECTION = 'dev__experiment'
+# Grouped Qdrant searches run as batched searches fetching this many points per
+# requested hit, grouped here, in rounds leaving out the groups found so far.
+# `0` sends Qdrant's grouped search instead, one request per vector
+QDRANT_GROUP_OVERSAMPLING = int(os.getenv('QDRANT_GROUP_OVERSAMPLING', 4))
+# Upserts of `/index` are cut at about this many bytes of vectors
+UPSERT_BATCH_BYTES = int(os.getenv('UPSERT_BATCH_BYTES', 4 * 1024 ** 2))
+# Upserts of a video sent before waiting for the oldest one
+UPSERT_CONCURRENCY = int(os.getenv('UPSERT_CONCURRENCY', 4))
+
+_POINT_NAMESPACE = uuid.UUID('5b0f3c8e-2f4d-4c1a-9a57-3d0e8c6f1b42')
+
+
+def point_id(video_name: str, frame: int) -> str:
+    """Id of the point of a frame, the same every time the video is indexed"""
+    return uuid.uuid5(_POINT_NAMESPACE, f'{video_name}/{frame}').hex
+
+
+@dataclass
+class Hit:
+    id: str
+    score: float
+    payload: dict
+
+
+class VectorStore(ABC):
+    """Frame vectors with their `video_name`, `video_id`, `frame` and `second` payload"""
+    name: str
+
+    @abstractmethod
+    def search(
+        self,
+        vectors: np.ndarray,
+        limit: int,
+        group_by: str | None = None,
+        group_size: int = 1,
+        video_names: list[str] | None = None,
+        exclude_video_names: list[str] | None = None,
+    ) -> list[list[Hit]]:
+        """
+        Per query vector the `limit` best hits by cosine similarity, or with
+        `group_by` the best `group_size` hits of its `limit` best groups.
+        Hits can be restricted to / kept out of a set of source videos
+        """
+        pass
+
+    @abstractmethod
+    def upsert(self, ids: list[str], vectors: np.ndarray, payloads: list[dict]):
+        """Writes the points, replacing points with the same ids, and returns once they are searchable"""
+        pass
+
+    def upsert_async(self, ids: list[str], vectors: np.ndarray, payloads: list[dict]) -> Future:
+        """
+        `upsert` whose future may resolve once the store accepted the
+        points, before they are searchable. Writes in flight together are
+        applied in any order, so their ids must be disjoint; an `upsert`
+        sent after every pending future resolved returns once all of them
+        are searchable
+        """
+        future = Future()
+        try:
+            future.set_result(self.upsert(ids, vectors, payloads))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    @abstractmethod
+    def delete_video(self, video_name: str, keep_ids: list[str] | None = None):
+        """Deletes the points of the video, but for `keep_ids`"""
+        pass
+
+
+class QdrantStore(VectorStore):
+    name = 'qdrant'
+
+    def __init__(self, endpoint: QdrantEndpoint, collection: str = COLLECTION, search_params: models.SearchParams | None = None):
+        self.endpoint = endpoint
+        self.collection = collection
+        self.search_params = search_params
+
+    @staticmethod
+    def _filter(video_names: list[str] | None, exclude_video_names: list[str] | None) -> models.Filter | None:
+        if not video_names and not exclude_video_names:
+            return None
+        return models.Filter(
+            must=[models.FieldCondition(key='video_name', match=models.MatchAny(any=video_names))] if video_names else None,
+            must_not=[models.FieldCondition(key='video_name', match=models.MatchAny(any=exclude_video_names))] if exclude_video_names else None,
+        )
+
+    def search(self, vectors, limit, group_by=None, group_size=1, video_names=None, exclude_video_names=None):
+        query = Query(
+            limit=limit,
+            filter=self._filter(video_names, exclude_video_names),
+            params=self.search_params,
+            with_payload=models.PayloadSelectorInclude(include=list(dict.fromkeys(['video_name', 'second', group_by or 'video_name']))),
+        )
+        if group_by and QDRANT_GROUP_OVERSAMPLING:
+            return self._search_grouped(vectors, query, group_by, group_size)
+        if group_by:
+            results = self.endpoint.search_groups(self.collection, vectors, query, group_by, group_size)
+        else:
+            results = self.endpoint.search_batch(self.collection, vectors, query)
+        return [[Hit(str(point.id), point.score, point.payload) for point in points] for points in results]
+
+    def _search_grouped(self, vectors: np.ndarray, query: Query, group_by: str, group_size: int) -> list[list[Hit]]:
+        """Grouped search as rounds of batched searches fetching `QDRANT_GROUP_OVERSAMPLING` points per hit"""
+        limit = query.limit
+        query = replace(query, limit=limit * group_size * QDRANT_GROUP_OVERSAMPLING)
+
+        def search_round(_, pending, keys):
+            filters = [self._exclude(query.filter, group_by, query_keys) for query_keys in keys]
+            results = self.endpoint.search_batch(self.collection, vectors[pending], query, filters)
+            return [[Hit(str(point.id), point.score, point.payload) for point in points] for points in results]
+
+        return group_rounds(len(vectors), search_round, lambda hit: hit.payload.get(group_by), limit, group_size)
+
+    @staticmethod
+    def _exclude(search_filter: models.Filter | None, group_by: str, keys: list) -> models.Filter | None:
+        if not keys:
+            return search_filter
+        exclude = models.FieldCondition(key=group_by, match=models.MatchAny(any=keys))
+        if search_filter is None:
+            return models.Filter(must_not=[exclude])
+        return models.Filter(must=search_filter.must, must_not=[*(search_filter.must_not or []), exclude])
+
+    def upsert(self, ids, vectors, payloads):
+        self.endpoint.upsert(self.collection, ids, vectors, payloads).result()
+
+    def upsert_async(self, ids, vectors, payloads):
+        # resolves once Qdrant accepted the update, accepted updates of a collection are applied in order
+        return self.endpoint.upsert(self.collection, ids, vectors, payloads, wait=False)
+
+    def delete_video(self, video_name, keep_ids=None):
+        self.endpoint.client().delete(self.collection, points_selector=models.FilterSelector(filter=models.Filter(
+            must=[models.FieldCondition(key='video_name', match=models.MatchValue(value=video_name))],
+            must_not=[models.HasIdCondition(has_id=keep_ids)] if keep_ids else None,
+        )))
+
+
+def group_rounds(
+    queries: int,
+    search_round: Callable[[int, list[int], list[list]], list[list[Hit]]],
+    group_key: Callable[[Hit], Hashable],
+    limit: int,
+    group_size: int,
+) -> list[list[Hit]]:
+    """
+    Best `group_size` hits of the `limit` best groups of every query, from
+    at most `limit` rounds of `search_round(round, pending, keys)`. A round
+    returns the hits, best first, of the `pending` queries outside the
+    group `keys` each already has. Adjacent frames of one video tend to
+    take all the best hits of a query, so a query is searched again while
+    it is short of `limit` groups and its last round found a new one
+    """
+    groups: list[dict] = [{} for _ in range(queries)]
+    pending = list(range(queries))
+    for round_ in range(limit):
+        if not pending:
+            break
+        results = search_round(round_, pending, [list(groups[i]) for i in pending])
+        still = []
+        for i, hits in zip(pending, results):
+            query_groups = groups[i]
+            found = len(query_groups)
+            for hit in hits:
+                key = group_key(hit)
+                if key not in query_groups:
+                    if len(query_groups) == limit:
+                        continue
+                    query_groups[key] = []
+                if len(query_groups[key]) < group_size:
+                    query_groups[key].append(hit)
+            if found < len(query_groups) < limit:
+                still.append(i)
+        pending = still
+    # best group first, the hits of a group together, as Qdrant returns them
+    return [
+        [hit for group in sorted(query_groups.values(), key=lambda hits: -hits[0].score) for hit in group]
+        for query_groups in groups
+    ]
+
+
+class PointWriter:
+    """
+    Upserts points into a store in batches of about `batch_bytes` of
+    vectors, keeping up to `concurrency` batches in flight while the
+    caller produces the next ones. The most recent full batch is held
+    back: `close` is the consistency barrier, it waits for the batches in
+    flight and then sends the last one waiting for it to be applied, and
+    with it everything sent before
+    """
+    def __init__(self, store: VectorStore, batch_bytes: int = UPSERT_BATCH_BYTES, concurrency: int = UPSERT_CONCURRENCY):
+        self.store = store
+        self.batch_bytes = batch_bytes
+        self.concurrency = max(concurrency, 1)
+        self.ids: list[str] = []
+        self.vectors: list[np.ndarray] = []
+        self.payloads: list[dict] = []
+        self.pending: list[Future] = []
+        self.held: tuple[list[str], np.ndarray, list[dict]] | None = None
+        self.batches = 0
+        # time the caller was blocked on the store
+        self.wait_s = 0.
+
+    def add(self, ids: list[str], vectors: np.ndarray, payloads: list[dict]):
+        self.ids.extend(ids)
+        self.vectors.append(np.asarray(vectors, dtype=np.float32))
+        self.payloads.extend(payloads)
+        if sum(v.nbytes for v in self.vectors) >= self.batch_bytes:
+            self._hold(self._take())
+
+    def _take(self) -> tuple[list[str], np.ndarray, list[dict]]:
+        batch = self.ids, np.concatenate(self.vectors), self.payloads
+        self.ids, self.vectors, self.payloads = [], [], []
+        self.batches += 1
+        return batch
+
+    def _hold(self, batch: tuple[list[str], np.ndarray, list[dict]]):
+        """Sends the batch held so far and holds this one"""
+        if self.held is not None:
+            start = time.perf_counter()
+            if len(self.pending) >= self.concurrency:
+                self.pending.pop(0).result()
+            self.pending.append(self.store.upsert_async(*self.held))
+            self.wait_s += time.perf_counter() - start
+        self.held = batch
+
+    def close(self):
+        if self.ids:
+            self._hold(self._take())
+        start = time.perf_counter()
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        if self.held is not None:
+            self.store.upsert(*self.held)
+            self.held = None
+        self.wait_s += time.perf_counter() - start
+
+
+_local_stores: dict[str, VectorStore] = {}
+_local_lock = threading.Lock()
+
+
+def get_store(
+    endpoint: QdrantEndpoint,
+    search_params: models.SearchParams | None = None,
+    collection: str = COLLECTION,
+) -> VectorStore:
+    """
+    Store of a collection a request works against: the collection on its
+    Qdrant endpoint, or the process-wide local index of the collection.
+    Local indexes of other collections live in subdirectories of `VSTORE_PATH`
+    """
+    if VSTORE == 'local':
+        with _local_lock:
+            if collection not in _local_stores:
+                from .local_store import LocalStore
+                _local_stores[collection] = LocalStore(
+                    VSTORE_PATH if collection == COLLECTION else os.path.join(VSTORE_PATH, collection)
+                )
+            return _local_stores[collection]
+    if VSTORE == 'qdrant':
+        return QdrantStore(endpoint, collection, search_params)
+    raise ValueError(f'Unknown vector store: {VSTORE}')
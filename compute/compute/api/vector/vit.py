@@ -1,10 +1,15 @@
 from typing import Iterable
+import os
+import time
 import warnings
+import numpy as np
 import torch
 
 from PIL import Image
 
 from .base import BaseImageEmbedder
+from .preprocess import BatchImagePreprocessor
+from .patches import BOX, get_token_slices
 from transformers import AutoModel, AutoProcessor
 
 class VitImageEmbedder(BaseImageEmbedder):
@@ -14,49 +19,85 @@ class VitImageEmbedder(BaseImageEmbedder):
             warnings.warn('CUDA is not available, switching to CPU.')
             
         self.device = device
-        self.processor = AutoProcessor.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name).to(device)
+        # weights saved locally are memory-mapped from safetensors, no hub lookups
+        local = os.path.isdir(model_name)
+        self.processor = AutoProcessor.from_pretrained(model_name, local_files_only=local)
+        self.model = AutoModel.from_pretrained(
+            model_name,
+            local_files_only=local,
+            use_safetensors=(True if local else None),
+        ).to(device)
+        self.preprocess = BatchImagePreprocessor.from_processor(self.processor)
+        # whole frames of region pooling have no HF counterpart to match
+        self.frame_preprocess = BatchImagePreprocessor.from_processor(self.processor, exact=False)
         
-        
-    
-    def vectorize(self, *images: Image.Image, batch_size: int) -> Iterable[list[float]]:                 
-        with torch.no_grad():
-            current_batch = []
-            for image in images:
-                inputs = self.processor(images=image, return_tensors='pt')
-                current_batch.append(inputs)
-                if len(current_batch) == batch_size:
-                    batch_inputs = {
-                        key: torch.cat([value[key] for value in current_batch], dim=0).to(self.device)
-                        for key in current_batch[0].keys()
-                    }
-                    outputs = self.model(**batch_inputs)
-                    embeddings = outputs.last_hidden_state[:, 0, :].cpu().tolist()
-                    for embedding in embeddings:
-                        yield embedding
-                    
-                    del embeddings
-                    del outputs
-                    del batch_inputs
-                    
-                    torch.cuda.empty_cache()
-                    current_batch = []
-
-            if current_batch:
-                batch_inputs = {
-                    key: torch.cat([value[key] for value in current_batch], dim=0).to(self.device)
-                    for key in current_batch[0].keys()
-                }
-                outputs = self.model(**batch_inputs)
-                embeddings = outputs.last_hidden_state[:, 0, :].cpu().tolist()
-                for embedding in embeddings:
-                    yield embedding
 
+    def _pixel_values(self, images: list[Image.Image]) -> torch.Tensor:
+        if self.preprocess is not None:
+            return self.preprocess(images, device=self.device)
+        # fast processors batch themselves, their output differs from `BatchImagePreprocessor`
+        return self.processor(images=list(images), return_tensors='pt')['pixel_values'].to(self.device)
+
+    def vectorize_array(self, *images: Image.Image, batch_size: int, dtype: np.dtype = np.float32) -> Iterable[np.ndarray]:
+        with torch.no_grad():
+            for i in range(0, len(images), batch_size):
+                start = time.perf_counter()
+                pixel_values = self._pixel_values(images[i:i + batch_size])
+                self.preprocess_s += time.perf_counter() - start
+                start = time.perf_counter()
+                outputs = self.model(pixel_values=pixel_values)
+                embeddings = outputs.last_hidden_state[:, 0, :].float().cpu().numpy()
+                self.inference_s += time.perf_counter() - start
+                yield np.ascontiguousarray(embeddings, dtype=dtype)
 
                 del embeddings
                 del outputs
-                del batch_inputs
+                del pixel_values
                 
                 torch.cuda.empty_cache()
-                
-                
\ No newline at end of file
+
+    def vectorize_regions(self, *images: Image.Image, boxes: list[BOX], batch_size: int, dtype: np.dtype = np.float32) -> Iterable[np.ndarray]:
+        """
+        Embeds image regions from a single forward pass per image.
+
+        The whole image goes through the model, resized with its aspect
+        ratio kept rather than center cropped (DINOv2 interpolates its
+        position embeddings), so the boxes cover the same parts of the
+        frame `get_patches` cuts. Yields `(n, len(boxes) + 1, dim)` arrays
+        per batch: descriptors of every box (normalized `(left, upper,
+        right, lower)`) mean-pooled from the patch tokens, followed by the
+        CLS embedding of the whole image.
+        """
+        if self.frame_preprocess is None:
+            raise ValueError(f'{type(self.processor).__name__} does not support region pooling')
+        patch_size = self.model.config.patch_size
+        skip = 1 + getattr(self.model.config, 'num_register_tokens', 0)
+        with torch.no_grad():
+            for i in range(0, len(images), batch_size):
+                start = time.perf_counter()
+                groups = list(self.frame_preprocess.frames(images[i:i + batch_size], patch_size, device=self.device))
+                self.preprocess_s += time.perf_counter() - start
+                start = time.perf_counter()
+                embeddings = [None] * sum(len(indices) for indices, _ in groups)
+                for indices, pixel_values in groups:
+                    hidden = self.model(pixel_values=pixel_values).last_hidden_state
+                    height = pixel_values.shape[2] // patch_size
+                    width = pixel_values.shape[3] // patch_size
+                    tokens = hidden[:, skip:].reshape(hidden.shape[0], height, width, hidden.shape[-1])
+
+                    regions = [
+                        tokens[:, rows, cols].mean(dim=(1, 2))
+                        for rows, cols in get_token_slices(boxes, height, width)
+                    ]
+                    regions.append(hidden[:, 0])
+                    for j, image_regions in zip(indices, torch.stack(regions, dim=1).float().cpu().numpy()):
+                        embeddings[j] = image_regions
+
+                    del hidden
+                self.inference_s += time.perf_counter() - start
+                yield np.ascontiguousarray(np.stack(embeddings), dtype=dtype)
+
+                del embeddings
+                del groups
+
+                torch.cuda.empty_cache()